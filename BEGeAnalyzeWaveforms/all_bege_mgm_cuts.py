@@ -2,9 +2,274 @@ import ROOT
 import SoudanDB.databases.bege_jc
 from SoudanDB.management.soudan_database import SoudanServer
 import cPickle as pickle
+import os
+import sys
+import shutil
+import tempfile
+import traceback
+import numpy
+import energy_tree_columns
+
+class SampledFunction:
+    """
+      Wraps a TF1 or TGraph (anything with Eval) so that it can be
+      evaluated on a numpy array, giving the values of Eval.  A 
+      TGraph, linear between (and beyond) its points, is sampled with
+      Eval at its points and at the ends of the range of the values
+      and then linearly interpolated, which is exact however far
+      apart the values are.  A TF1 is sampled once on num_samples
+      points over its range and linearly interpolated, values outside
+      the range are evaluated with Eval.
+
+      If thresholds are given (e.g. the risetimes compared to the 
+      cut), the values where the interpolation is within its error 
+      of the threshold are evaluated with Eval, so that comparing 
+      with the thresholds gives the same result as with Eval.
+    """
+    num_samples = 4096
+
+    def __init__(self, function, num_samples=None):
+        if num_samples is None: num_samples = self.num_samples
+        self.function = function
+        self.points = None
+        if hasattr(function, "GetN"):
+            self.points = numpy.array([function.GetX()[i] 
+                                       for i in range(function.GetN())])
+            return
+        self.grid = numpy.linspace(function.GetXmin(), function.GetXmax(), num_samples)
+        self.samples = evaluate_on_grid(function, self.grid)
+        # The interpolation error, estimated from the middle of the 
+        # intervals (with a safety factor), and the rounding error
+        middle = 0.5*(self.grid[1:] + self.grid[:-1])
+        error = numpy.abs(evaluate_on_grid(function, middle) - 
+                          numpy.interp(middle, self.grid, self.samples))
+        self.error_bound = (2*numpy.nanmax(error) + 
+                            1e-12*numpy.nanmax(numpy.abs(self.samples)))
+
+    def evaluate_exactly(self, values):
+        """
+          Eval at each distinct value of values
+        """
+        if len(values) == 0: return numpy.empty(0)
+        unique, inverse = numpy.unique(values, return_inverse=True)
+        return numpy.array([self.function.Eval(x) for x in unique])[inverse]
+
+    def evaluate(self, values, thresholds=None):
+        """
+          Eval at each of values (finite, 1-d)
+        """
+        if len(values) == 0: return numpy.empty(0)
+        if self.points is not None:
+            x_min, x_max = values.min(), values.max()
+            inside = self.points[(self.points > x_min) & (self.points < x_max)]
+            grid = numpy.union1d(inside, [x_min, x_max])
+            samples = numpy.array([self.function.Eval(x) for x in grid])
+            return numpy.interp(values, grid, samples)
+        output = numpy.interp(values, self.grid, self.samples)
+        exact = (values < self.grid[0]) | (values > self.grid[-1])
+        if thresholds is not None:
+            exact |= numpy.abs(output - thresholds) <= self.error_bound
+        output[exact] = self.evaluate_exactly(values[exact])
+        return output
+
+    def __call__(self, values, thresholds=None):
+        values = numpy.asarray(values, dtype=float)
+        if thresholds is not None:
+            thresholds = numpy.broadcast_to(numpy.asarray(thresholds, dtype=float), 
+                                            values.shape)
+        output = numpy.empty(values.shape)
+        output.fill(numpy.nan)
+        is_finite = numpy.isfinite(values)
+        if thresholds is not None: thresholds = thresholds[is_finite]
+        output[is_finite] = self.evaluate(values[is_finite], thresholds)
+        return output
+
+def evaluate_on_grid(function, energies):
+    """
+      Eval of function (TF1, TGraph) at each of energies (array)
+    """
+    energies = numpy.asarray(energies, dtype=float)
+    return numpy.reshape([function.Eval(x) for x in energies.flat], energies.shape)
+
+# Process-wide cache of the cut functions from the database,
+# filled on first use by get_cut_functions
+cut_functions_cache = {}
+
+def fetch_cut_functions(server):
+    """
+      Grab all cut functions from the database documents.  Returns
+      a dictionary:
+        { 'trigger_efficiency' : erfc_function,
+          'microphonics' : (lower_cut, upper_cut, efficiency_function), 
+          'rise_cuts' : { percentage : (low_energy_function, 
+                                        high_energy_function, 
+                                        efficiency_function) },
+          'odd_pulse_cut' : pulse_cut }
+    """
+    # Grab the trigger efficiency 
+    trigger_doc = server.get_trigger_efficiency_doc()
+    trigger_efficiency = trigger_doc.trigger_efficiency['standard'].efficiency_function
+
+    # Grab the microphonics cuts
+    microdoc = server.get_microphonics_cut_doc( )
+    temp = microdoc.all_micro_cuts[99]
+    microphonics = (temp.lower_cut, temp.upper_cut, temp.efficiency_function)
+
+    # Grab the risetime cuts, all percentages
+    risedoc = server.get_rise_time_cut_doc() 
+    rise_cuts = {}
+    for percentage, temp in risedoc.all_rise_cuts.items():
+        rise_cuts[percentage] = (temp.low_energy_function, 
+                                 temp.high_energy_function, 
+                                 temp.efficiency_function)
+
+    return { 'trigger_efficiency' : trigger_efficiency,
+             'microphonics' : microphonics,
+             'rise_cuts' : rise_cuts,
+             'odd_pulse_cut' : server.get_pulse_cut_doc().pulse_cut }
+
+def get_cut_functions(server=None):
+    """
+      Return the cut functions (see fetch_cut_functions), only
+      contacting the database the first time this is called in a
+      process.  server defaults to a SoudanServer.
+    """
+    if not cut_functions_cache:
+        if server is None: server = SoudanServer()
+        cut_functions_cache.update(fetch_cut_functions(server))
+    return cut_functions_cache
+
+def clear_cut_functions_cache():
+    """
+      Invalidate the cache, the next selector will refetch
+      the cut functions from the database.
+    """
+    cut_functions_cache.clear()
+
+def save_cut_functions(file_name, server=None):
+    """
+      Snapshot the cut functions to a local file, which can be
+      passed as cut_file to MGMBegeAnalysisSelector to avoid
+      using the database at all.
+    """
+    output = open(file_name, "wb")
+    pickle.dump(get_cut_functions(server), output, pickle.HIGHEST_PROTOCOL)
+    output.close()
+
+def load_cut_functions(file_name):
+    """
+      Load the cut functions from a file written by save_cut_functions
+    """
+    input = open(file_name, "rb")
+    cut_functions = pickle.load(input)
+    input.close()
+    return cut_functions
+
+class CutDocument:
+    """
+      A database document of LocalCutServer, its fields as attributes
+    """
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+class LocalCutServer:
+    """
+      Local stand-in for SoudanServer, serving the documents of 
+      the cut functions (as read by fetch_cut_functions) with simple
+      functions, for testing without the database.  They roughly
+      match the synthetic triggers of benchmark.py: the energy ratio
+      of channels 0 and 1 is around 1 and the risetimes are 0.2-0.8
+      mus.  The low energy risetime cuts are TGraphs, the others 
+      TF1s.  The number of documents fetched is counted in 
+      num_fetched.
+    """
+    def __init__(self, percentages=(80, 90, 95)):
+        self.num_fetched = 0
+        def function(name, formula, x_min=0., x_max=0.1):
+            return ROOT.TF1("local_%s" % name, formula, x_min, x_max)
+        self.trigger_efficiency = function("trigger_efficiency", 
+                                           "0.5*TMath::Erfc((0.002 - x)/0.001)")
+        self.microphonics = CutDocument(lower_cut=function("lower_cut", "0.8 - x"),
+                                        upper_cut=function("upper_cut", "1.2 + x"),
+                                        efficiency_function=function(
+                                          "microphonics_efficiency", "0.99"))
+        self.rise_cuts = {}
+        energies = numpy.linspace(0., 0.05, 11)
+        for percentage in percentages:
+            scale = percentage/90.
+            cut = scale*(0.6 + 4*energies)
+            self.rise_cuts[percentage] = CutDocument(
+              low_energy_function=ROOT.TGraph(len(energies), energies, cut),
+              high_energy_function=function("upper_rise_cut_%i" % percentage,
+                                            "%g*(0.6 + 40*x)" % scale, 0., 0.01),
+              efficiency_function=function("rise_efficiency_%i" % percentage,
+                                           "%g" % (percentage/100.)))
+        self.pulse_cut = function("odd_pulse_cut", "140 + 6000*x")
+
+    def get_trigger_efficiency_doc(self):
+        self.num_fetched += 1
+        return CutDocument(trigger_efficiency={ 'standard' : CutDocument(
+                             efficiency_function=self.trigger_efficiency) })
+
+    def get_microphonics_cut_doc(self):
+        self.num_fetched += 1
+        return CutDocument(all_micro_cuts={ 99 : self.microphonics })
+
+    def get_rise_time_cut_doc(self):
+        self.num_fetched += 1
+        return CutDocument(all_rise_cuts=self.rise_cuts)
+
+    def get_pulse_cut_doc(self):
+        self.num_fetched += 1
+        return CutDocument(pulse_cut=self.pulse_cut)
+
+def check_cut_functions_cache(snapshot_file_name, server=None):
+    """
+      Check the cut function cache and snapshots with server (a
+      LocalCutServer by default): a second selector does not fetch
+      the functions again, clear_cut_functions_cache does, and a
+      selector is built from the snapshot (written to 
+      snapshot_file_name) without SoudanServer, with the same 
+      functions.  Raises a RuntimeError if any of this fails.  The
+      cache is cleared afterwards.
+    """
+    global SoudanServer
+    if server is None: server = LocalCutServer()
+    clear_cut_functions_cache()
+    try:
+        get_cut_functions(server)
+        num_fetched = server.num_fetched
+        selector = MGMBegeAnalysisSelector()
+        MGMBegeAnalysisSelector()
+        if server.num_fetched != num_fetched:
+            raise RuntimeError("The cut functions were fetched again by a second selector")
+        clear_cut_functions_cache()
+        save_cut_functions(snapshot_file_name, server)
+        if server.num_fetched != 2*num_fetched:
+            raise RuntimeError("The cut functions were not refetched after clearing the cache")
+
+        # Without the database (or the cache)
+        clear_cut_functions_cache()
+        database_server = SoudanServer
+        def no_database(): raise RuntimeError("SoudanServer used with a snapshot")
+        SoudanServer = no_database
+        try:
+            snapshot_selector = MGMBegeAnalysisSelector(cut_file=snapshot_file_name)
+        finally:
+            SoudanServer = database_server
+        energies = numpy.linspace(0., 0.1, 11)
+        for function in ('trigger_efficiency', 'risetime_efficiency', 
+                         'microphonics_efficiency', 'risetime_cut_graph', 
+                         'upper_risetime_cut_graph', 'upper_cut', 'lower_cut'):
+            values = [evaluate_on_grid(getattr(a_selector, "get_%s" % function)(), energies)
+                      for a_selector in (selector, snapshot_selector)]
+            if not numpy.allclose(values[0], values[1]):
+                raise RuntimeError("The snapshot %s differs" % function)
+    finally:
+        clear_cut_functions_cache()
 
 class MGMBegeAnalysisSelector():
-    def __init__(self, percentage=90):
+    def __init__(self, percentage=90, cut_file=None):
         ROOT.gROOT.cd()
         self.microphonics_list = ROOT.TEventList("microphonics_list", "microphonics_list")
         self.risetime_list = ROOT.TEventList("risetime_list", "risetime_list")
@@ -13,24 +278,22 @@ class MGMBegeAnalysisSelector():
         self.LN_cut_on_list = ROOT.TEventList("LN_cut_on_list", "LN_cut_on_list")
         self.combination_list = ROOT.TEventList("combination_list", "combination_list")
        
+        # The cut functions come from the database (cached per process),
+        # or from a local snapshot if cut_file is given.
         # The risetime cut is a dump from the results of the rise-time fit. 
-        server = SoudanServer()
+        if cut_file is None: cut_functions = get_cut_functions()
+        else: cut_functions = load_cut_functions(cut_file)
        
         # Grab the trigger efficiency 
-        trigger_doc = server.get_trigger_efficiency_doc()
-        self.erfc_function = trigger_doc.trigger_efficiency['standard'].efficiency_function
+        self.erfc_function = cut_functions['trigger_efficiency']
        
         # Grab the microphonics cuts
-        microdoc = server.get_microphonics_cut_doc( )
-        temp = microdoc.all_micro_cuts[99]
         self.lower_cut, self.upper_cut, self.microphonics_efficiency = \
-              temp.lower_cut, temp.upper_cut, temp.efficiency_function
+              cut_functions['microphonics']
        
         # Grab the risetime cuts
-        risedoc = server.get_rise_time_cut_doc() 
-        temp = risedoc.all_rise_cuts[percentage] 
         self.risetime_cut, self.upper_risetime_cut, self.risetime_efficiency = \
-              temp.low_energy_function, temp.high_energy_function, temp.efficiency_function
+              cut_functions['rise_cuts'][percentage] 
        
         self.cuts_list = [self.get_risetime_cut_list,
                           self.get_microphonics_cuts_list,
@@ -39,13 +302,25 @@ class MGMBegeAnalysisSelector():
         self.eff_list =  [self.risetime_efficiency,
                           self.microphonics_efficiency,
                           self.erfc_function]
-        self.odd_pulse_cut = server.get_pulse_cut_doc().pulse_cut
+        self.odd_pulse_cut = cut_functions['odd_pulse_cut']
+
+        # Array versions of the cut functions for the columnar cuts
+        self.sampled_risetime_cut = SampledFunction(self.risetime_cut)
+        self.sampled_upper_risetime_cut = SampledFunction(self.upper_risetime_cut)
+        self.sampled_lower_cut = SampledFunction(self.lower_cut)
+        self.sampled_upper_cut = SampledFunction(self.upper_cut)
+        self.cuts_mask_list = [self.get_risetime_cut_mask,
+                               self.get_microphonics_cuts_mask,
+                               self.get_LN_fill_cut_mask,
+                               self.get_odd_pulse_cut_mask]
+        # Combined efficiency of each bin grid, see get_all_cuts_efficiency_array
+        self.efficiency_grid_cache = {}
 
     @classmethod
-    def get_available_rise_cuts(cls):
-        server = SoudanServer()
-        risedoc = server.get_rise_time_cut_doc() 
-        return risedoc.all_rise_cuts.keys()
+    def get_available_rise_cuts(cls, cut_file=None):
+        if cut_file is None: cut_functions = get_cut_functions()
+        else: cut_functions = load_cut_functions(cut_file)
+        return cut_functions['rise_cuts'].keys()
 
     def get_trigger_efficiency(self): return self.erfc_function
     def get_risetime_efficiency(self): return self.risetime_efficiency
@@ -135,6 +410,22 @@ class MGMBegeAnalysisSelector():
             temp_str += "*%s" % self.eff_list[i].GetName()
         efficiency_total = ROOT.TF1("efficiency_total", temp_str)
         return efficiency_total
+
+    def get_all_cuts_efficiency_array(self, energies):
+        """
+          The combined efficiency (as get_all_cuts_efficiency: trigger
+          x microphonics x risetime) at each of energies, e.g. the bin
+          centers of a spectrum.  Each efficiency function is evaluated
+          once per distinct grid of energies, the values are reused
+          by later calls with the same grid.
+        """
+        energies = numpy.asarray(energies, dtype=float)
+        key = (energies.shape, energies.tostring())
+        if key not in self.efficiency_grid_cache:
+            efficiency = numpy.ones(energies.shape)
+            for function in self.eff_list: efficiency *= evaluate_on_grid(function, energies)
+            self.efficiency_grid_cache[key] = efficiency
+        return self.efficiency_grid_cache[key]
         
 
     def get_microphonics_cuts_list(self, tree):
@@ -159,3 +450,269 @@ class MGMBegeAnalysisSelector():
         self.microphonics_list.Sort()
         return self.microphonics_list
 
+    # The following evaluate the cuts as boolean masks over the
+    # columns of the energy tree (see energy_tree_columns), giving
+    # the same selection as the corresponding get_*_list functions.
+    # The odd pulse, LN fill and microphonics masks also take the 
+    # feature table instead (energy_tree_columns.load_event_features).
+    def get_energy(self, columns, chan):
+        return (columns["channel_info.averagepeak"][:,chan] - 
+                columns["channel_info.baseline"][:,chan])
+
+    def get_odd_pulse_cut_mask(self, columns):
+        features = energy_tree_columns.get_event_features(columns)
+        energy = features["energy_1"]
+        diff = features["rise_max_min"]
+        return (energy > 0.01) | (diff < 140 + (60./0.01)*energy)
+
+    def get_risetime_cut_mask(self, columns):
+        energy = self.get_energy(columns, 1)
+        energytwo = self.get_energy(columns, 2)
+        risetime = columns["risetime_info.risetime"][:,0]*1e-3
+        risetimetwo = columns["risetime_info.risetime"][:,1]*1e-3
+        
+        use_upper = energy >= 0.05 
+        try_both = (energy < 0.05) & (energy >= 0.045)
+        # Each cut is only evaluated for the events it applies to
+        pass_upper = numpy.zeros(len(energy), dtype=bool)
+        upper = use_upper | try_both
+        pass_upper[upper] = (risetimetwo[upper] <= 
+                             self.sampled_upper_risetime_cut(energytwo[upper],
+                                                             risetimetwo[upper]))
+        pass_lower = numpy.zeros(len(energy), dtype=bool)
+        lower = ~use_upper
+        pass_lower[lower] = risetime[lower] <= self.sampled_risetime_cut(energy[lower],
+                                                                          risetime[lower])
+        return numpy.where(use_upper, pass_upper, 
+                 numpy.where(try_both, pass_upper & pass_lower, pass_lower))
+
+    def get_LN_fill_on_cut_mask(self, columns):
+        return columns["pulser_on"] == 1
+
+    def get_LN_fill_cut_mask(self, columns):
+        return columns["pulser_on"] != 1
+
+    def get_microphonics_cuts_mask(self, columns):
+        features = energy_tree_columns.get_event_features(columns)
+        energy = features["energy_1"]
+        ratio = features["energy_ratio"]
+        mask = (~(features["baseline_1"] > -0.008) &
+                ~(features["minimum_1"] <= -0.02) & 
+                (features["pulser_on"] != 1))
+        # The band is only evaluated where it applies, energy <= 0.05
+        band = mask & ~(energy > 0.05)
+        in_band = ((ratio[band] <= self.sampled_upper_cut(energy[band], ratio[band])) & 
+                   (ratio[band] >= self.sampled_lower_cut(energy[band], ratio[band])))
+        mask[band] = in_band
+        return mask
+
+    def get_all_cuts_mask(self, columns):
+        mask = numpy.ones(len(columns["pulser_on"]), dtype=bool)
+        for func in self.cuts_mask_list: mask &= func(columns)
+        return mask
+
+    def check_cut_masks(self, tree, columns=None):
+        """
+          Check that each get_*_mask gives the same selection as the
+          corresponding get_*_list of tree (columns are read from the
+          tree if not given).  Returns the number of events selected
+          differently by each cut, e.g. { 'microphonics_cuts' : 0, ... },
+          raising a RuntimeError if any differ.
+        """
+        if columns is None: columns = energy_tree_columns.read_energy_columns(tree)
+        differences = {}
+        for name in ('odd_pulse_cut', 'risetime_cut', 'LN_fill_cut', 
+                     'LN_fill_on_cut', 'microphonics_cuts'):
+            event_list = getattr(self, "get_%s_list" % name)(tree)
+            listed = numpy.zeros(len(columns["pulser_on"]), dtype=bool)
+            listed[[event_list.GetEntry(i) for i in range(event_list.GetN())]] = True
+            mask = getattr(self, "get_%s_mask" % name)(columns)
+            differences[name] = int((listed != mask).sum())
+        different = ["%s (%i)" % (name, number) for name, number in 
+                     sorted(differences.items()) if number]
+        if different:
+            raise RuntimeError("Masks differ from the event lists: %s" % ", ".join(different))
+        return differences
+
+    def get_event_list_from_mask(self, mask, name="combination_list"):
+        """
+          Export a mask to a (sorted) TEventList 
+        """
+        ROOT.gROOT.cd()
+        event_list = ROOT.TEventList(name, name) 
+        for i in numpy.flatnonzero(mask): event_list.Enter(int(i))
+        return event_list
+
+    def get_all_cuts_list_from_columns(self, columns):
+        """
+          Columnar version of get_all_cuts_list, e.g.:
+            columns = energy_tree_columns.load_energy_columns("run.root")
+            selector.get_all_cuts_list_from_columns(columns)
+        """
+        self.combination_list = self.get_event_list_from_mask(
+                                  self.get_all_cuts_mask(columns))
+        return self.combination_list
+
+    def get_energy_spectrum(self, columns, bins, range=None, channel=1, mask=None):
+        """
+          Histogram of the energy (averagepeak - baseline of channel)
+          of the events passing all the cuts, or those selected by
+          mask, directly from the columns.  bins and range are as for
+          numpy.histogram, returns (counts, bin_edges).
+        """
+        if mask is None: mask = self.get_all_cuts_mask(columns)
+        energy = self.get_energy(columns, channel)[mask]
+        return numpy.histogram(energy[numpy.isfinite(energy)], bins, range)
+
+    def get_corrected_energy_spectrum(self, columns, bins, range=None, channel=1, 
+                                      mask=None):
+        """
+          get_energy_spectrum divided by the combined efficiency of
+          the cuts at the bin centers.  Returns (spectrum, errors,
+          bin_edges), the errors from the counts, bins without 
+          efficiency are NaN, e.g.:
+
+            columns = energy_tree_columns.load_energy_columns("run.root")
+            spectrum, errors, edges = selector.get_corrected_energy_spectrum(
+                                        columns, 200, (0, 0.1))
+        """
+        counts, edges = self.get_energy_spectrum(columns, bins, range, channel, mask)
+        efficiency = self.get_all_cuts_efficiency_array(0.5*(edges[1:] + edges[:-1]))
+        old_settings = numpy.seterr(divide='ignore', invalid='ignore')
+        spectrum = numpy.where(efficiency > 0, counts/efficiency, numpy.nan)
+        errors = numpy.where(efficiency > 0, numpy.sqrt(counts)/efficiency, numpy.nan)
+        numpy.seterr(**old_settings)
+        return spectrum, errors, edges
+
+# The columns and the percentage-independent results of a scan, 
+# set by scan_rise_cuts and inherited by its (forked) workers
+scan_state = {}
+
+def scan_rise_cut(percentage):
+    """
+      Worker function of scan_rise_cuts, returns (percentage, mask,
+      efficiency) of one risetime cut.
+    """
+    selector = MGMBegeAnalysisSelector(percentage, scan_state['cut_file'])
+    mask = numpy.zeros(scan_state['num_entries'], dtype=bool)
+    mask[scan_state['selected']] = selector.get_risetime_cut_mask(scan_state['columns'])
+    efficiency = None
+    if scan_state['energies'] is not None:
+        efficiency = scan_state['efficiency']*evaluate_on_grid(
+                       selector.get_risetime_efficiency(), scan_state['energies'])
+    return percentage, mask, efficiency
+
+def run_scan_rise_cut(percentage, result_file_name, error_file_name):
+    """
+      Target of the process of a percentage in scan_rise_cuts: 
+      scan_rise_cut, saving the mask and efficiency to 
+      result_file_name (npz).  On failure, the traceback is written
+      to error_file_name and the process exits with 1.
+    """
+    try:
+        percentage, mask, efficiency = scan_rise_cut(percentage)
+        results = { 'mask' : mask }
+        if efficiency is not None: results['efficiency'] = efficiency
+        numpy.savez(result_file_name, **results)
+    except Exception:
+        error_file = open(error_file_name, "w")
+        try:
+            error_file.write(traceback.format_exc())
+        finally:
+            error_file.close()
+        sys.exit(1)
+
+def run_scan_rise_cut_processes(percentages, jobs):
+    """
+      scan_rise_cut of each of percentages in its own process, jobs
+      at a time (see analyze_waveforms.run_processes), so that a 
+      worker dying (e.g. a segfault in ROOT) fails its percentage
+      instead of hanging the scan.  Returns the list of results of
+      scan_rise_cut, raising a RuntimeError naming the percentages
+      that failed, after reporting each failure.
+    """
+    import analyze_waveforms
+    temp_dir = tempfile.mkdtemp()
+    try:
+        file_names = [(os.path.join(temp_dir, "rise_cut_%s.npz" % percentage),
+                       os.path.join(temp_dir, "rise_cut_%s.error" % percentage))
+                      for percentage in percentages]
+        exit_codes = analyze_waveforms.run_processes(
+                       [(run_scan_rise_cut, (percentage,) + names) 
+                        for percentage, names in zip(percentages, file_names)], jobs)
+        results = []
+        failed = []
+        for percentage, (result_file_name, error_file_name), exit_code in \
+              zip(percentages, file_names, exit_codes):
+            if exit_code != 0:
+                if os.path.exists(error_file_name): error = open(error_file_name).read()
+                else: error = analyze_waveforms.get_exit_code_message(exit_code)
+                print "Risetime cut %s failed:" % percentage
+                print error
+                failed.append(str(percentage))
+                continue
+            result = numpy.load(result_file_name)
+            efficiency = None
+            if 'efficiency' in result.files: efficiency = result['efficiency']
+            results.append((percentage, result['mask'], efficiency))
+        if failed:
+            raise RuntimeError("Risetime cuts %s of the scan failed" % ", ".join(failed))
+    finally:
+        shutil.rmtree(temp_dir)
+    return results
+
+def scan_rise_cuts(columns, percentages=None, cut_file=None, energies=None, jobs=1):
+    """
+      Evaluate all the cuts for each of the risetime cut percentages
+      (default: all those available), giving the same selection as
+      MGMBegeAnalysisSelector(percentage).get_all_cuts_mask for each.
+      columns are those of energy_tree_columns, or the name of the 
+      file to load them from (once).  The cuts that do not depend on
+      the percentage (microphonics, LN fill, odd pulse) are 
+      evaluated once, the risetime cuts only for the events passing 
+      them, in jobs worker processes (see run_scan_rise_cut_processes).
+
+      Returns { percentage : { 'selected' : number of events,
+                               'mask' : boolean array over the entries,
+                               'efficiency' : combined efficiency } }
+      where the efficiency (as get_all_cuts_efficiency_array) is 
+      evaluated at energies, e.g. the bin centers of a spectrum, or 
+      is None if energies is not given.
+    """
+    if isinstance(columns, basestring):
+        columns = energy_tree_columns.load_energy_columns(columns)
+    if cut_file is None: get_cut_functions()
+    if percentages is None:
+        percentages = sorted(MGMBegeAnalysisSelector.get_available_rise_cuts(cut_file))
+
+    selector = MGMBegeAnalysisSelector(percentages[0], cut_file)
+    common_mask = numpy.ones(len(columns["pulser_on"]), dtype=bool)
+    for func in selector.cuts_mask_list: 
+        if func != selector.get_risetime_cut_mask: common_mask &= func(columns)
+    selected = numpy.flatnonzero(common_mask)
+
+    scan_state.clear()
+    scan_state['cut_file'] = cut_file
+    scan_state['num_entries'] = len(common_mask)
+    scan_state['selected'] = selected
+    # Only the columns of the risetime cut, for the selected events
+    scan_state['columns'] = dict((key, columns[key][selected]) for key in 
+                                 ("channel_info.averagepeak", "channel_info.baseline",
+                                  "risetime_info.risetime"))
+    scan_state['energies'] = energies
+    if energies is not None:
+        scan_state['efficiency'] = (evaluate_on_grid(selector.get_trigger_efficiency(), energies)*
+                                    evaluate_on_grid(selector.get_microphonics_efficiency(), 
+                                                     energies))
+    try:
+        if jobs > 1 and len(percentages) > 1:
+            results = run_scan_rise_cut_processes(percentages, jobs)
+        else:
+            results = [scan_rise_cut(percentage) for percentage in percentages]
+    finally:
+        scan_state.clear()
+
+    return dict((percentage, { 'selected' : int(mask.sum()),
+                               'mask' : mask,
+                               'efficiency' : efficiency })
+                for percentage, mask, efficiency in results)
@@ -3,9 +3,21 @@ import ROOT
 import array
 from ctypes import c_ulonglong
 import sys
+import os
 import pywt
 import math
 import numpy
+import multiprocessing
+import optparse
+import shutil
+import tempfile
+import time
+import json
+import traceback
+import bege_binary
+import energy_tree_columns
+import profiling
+import run_config
 def get_threshold_list():
       return [ 0.0413365741474,
                0.0334049964465,
@@ -15,6 +27,38 @@ def get_threshold_list():
                0.00835124911162 ]
 
 
+def idwt_per(cA, cD, wavelet):
+    """
+      Single-level inverse dwt with periodic boundary conditions
+      (pywt mode 'per') along the last axis of cA and cD.  Any
+      leading axes are treated as independent transforms, so a
+      whole stack of sub-sequences is done in one numpy pass.
+
+      wavelet must be a pywt.Wavelet object.
+    """
+    num_points = 2*cA.shape[-1]
+    if wavelet.name in ('haar', 'db1'):
+        # Closed form for the haar wavelet:
+        #   x[2k] = (cA[k] + cD[k])/sqrt(2), x[2k+1] = (cA[k] - cD[k])/sqrt(2)
+        output = numpy.empty(cA.shape[:-1] + (num_points,))
+        output[..., 0::2] = cA + cD
+        output[..., 1::2] = cA - cD
+        output *= math.sqrt(0.5)
+        return output
+
+    # Generic case, upsample and perform a circular convolution
+    # with the reconstruction filters.
+    up_cA = numpy.zeros(cA.shape[:-1] + (num_points,))
+    up_cD = numpy.zeros(cD.shape[:-1] + (num_points,))
+    up_cA[..., 0::2] = cA
+    up_cD[..., 0::2] = cD
+    shift = len(wavelet.rec_lo)//2 - 1
+    output = numpy.zeros(up_cA.shape)
+    for i, (lo, hi) in enumerate(zip(wavelet.rec_lo, wavelet.rec_hi)):
+        output += lo*numpy.roll(up_cA, i - shift, axis=-1)
+        output += hi*numpy.roll(up_cD, i - shift, axis=-1)
+    return output
+
 def iswt(coefficients, wavelet):
     """
       Input parameters: 
@@ -27,6 +71,61 @@ def iswt(coefficients, wavelet):
         wavelet
           Either the name of a wavelet or a Wavelet object
 
+      At each level j, the 2^(j-1) phase offsets of the sequence
+      are independent.  Instead of looping over them (see iswt_slow),
+      the sequence is reshaped so that each offset is a row and all
+      rows are inverted at once with idwt_per.  Leading axes of the
+      coefficients are carried through, so an array of waveforms
+      (shape [..., length]) may be passed as well.
+    """
+    if not isinstance(wavelet, pywt.Wavelet):
+        wavelet = pywt.Wavelet(wavelet)
+
+    # Copy, avoid modification of input data
+    output = numpy.array(coefficients[0][0], dtype=float) 
+    leading_shape = output.shape[:-1]
+    length = output.shape[-1]
+
+    #num_levels, equivalent to the decomposition level, n
+    num_levels = len(coefficients)
+    for j in range(num_levels,0,-1): 
+        step_size = 2**(j-1)
+        new_shape = leading_shape + (length//step_size, step_size)
+        cD = numpy.asarray(coefficients[num_levels - j][1], dtype=float)
+
+        # Row 'first' holds output[first::step_size], i.e. the
+        # indices that iswt_slow transforms for that offset.
+        cA = output.reshape(new_shape).swapaxes(-1, -2)
+        cD = cD.reshape(new_shape).swapaxes(-1, -2)
+
+        # inverse dwt of the even and odd indices of every row
+        x1 = idwt_per(cA[..., 0::2], cD[..., 0::2], wavelet)
+        x2 = idwt_per(cA[..., 1::2], cD[..., 1::2], wavelet)
+
+        # perform a circular shift right, average and put back
+        # into the original ordering 
+        x1 += numpy.roll(x2, 1, axis=-1)
+        x1 /= 2.
+        output = x1.swapaxes(-1, -2).reshape(leading_shape + (length,))
+
+    return output
+
+def iswt_slow(coefficients, wavelet):
+    """
+      Original per-offset implementation of the inverse stationary
+      wavelet transform.  It is kept to cross-check iswt, which
+      must give the same result to floating-point tolerance.
+
+      Input parameters: 
+
+        coefficients
+          approx and detail coefficients, arranged in level value 
+          exactly as output from swt:
+          e.g. [(cA1, cD1), (cA2, cD2), ..., (cAn, cDn)]
+
+        wavelet
+          Either the name of a wavelet or a Wavelet object
+
     """
     output = coefficients[0][0].copy() # Avoid modification of input data
 
@@ -88,8 +187,484 @@ def apply_threshold(output, scaler = 1., input=None):
         cD = pywt.thresholding.hard(cD, thresh)
         output[j] = (cA, cD)
 
+def swt_block(data, wavelet, level):
+    """
+      Stationary wavelet transform along the last axis of data,
+      equivalent to calling pywt.swt on every row.  Output is
+      arranged exactly as from swt:
+          [(cAn, cDn), ..., (cA2, cD2), (cA1, cD1)]
+      where each cA, cD has the same shape as data.
+    """
+    if not isinstance(wavelet, pywt.Wavelet):
+        wavelet = pywt.Wavelet(wavelet)
+    filter_length = len(wavelet.dec_lo)
+    cA = numpy.asarray(data, dtype=float)
+    output = []
+    for j in range(1, level+1):
+        # 'a trous' filters, upsampled by 2^(j-1)
+        step_size = 2**(j-1)
+        shift = step_size*(filter_length//2)
+        new_cA = numpy.zeros(cA.shape)
+        new_cD = numpy.zeros(cA.shape)
+        for i, (lo, hi) in enumerate(zip(wavelet.dec_lo, wavelet.dec_hi)):
+            rolled = numpy.roll(cA, i*step_size - shift, axis=-1)
+            new_cA += lo*rolled
+            new_cD += hi*rolled
+        cA = new_cA
+        output.insert(0, (cA, new_cD))
+    return output
+
+def apply_threshold_block(output, scaler = 1., input=None):
+    """
+        Block version of apply_threshold, where each cD is an
+        array of shape [num_waveforms, length] (e.g. from
+        swt_block).  Hard thresholding is applied in place.
+
+        If input is None, the thresholds are calculated for
+        each waveform (row) separately.
+    """
+    for j in range(len(output)):
+        cA, cD = output[j]
+        if input is None:
+            dev = numpy.median(numpy.abs(cD -
+                    numpy.median(cD, axis=-1)[..., numpy.newaxis]), axis=-1)/0.6745
+            thresh = (math.sqrt(2*math.log(cD.shape[-1]))*dev*scaler)[..., numpy.newaxis]
+        else: thresh = scaler*input[j]
+        cD[numpy.abs(cD) < thresh] = 0
+
+def denoise_waveforms(waveforms, wavelet, level, scaler = 1., thresholds=None):
+    """
+      Wavelet denoising of a block of waveforms in one pass:
+      swt, hard thresholding and iswt.
+
+        waveforms
+          2-d array, [num_waveforms, length], length must
+          be divisible by 2^level.
+
+        thresholds, scaler
+          as for apply_threshold, e.g.:
+            denoise_waveforms(data, 'haar', 6, 0.8, get_threshold_list())
+
+      Returns a 2-d array of the denoised waveforms.
+    """
+    output = swt_block(waveforms, wavelet, level)
+    apply_threshold_block(output, scaler, thresholds)
+    return iswt(output, wavelet)
+
+class SWTDenoiser:
+    """
+      Wavelet denoising as denoise_waveforms (swt, hard thresholding
+      with the given thresholds, iswt), but with all the buffers 
+      allocated once and reused for every call, so that a long run 
+      does not allocate per event.  The waveforms are processed 
+      rows_per_pass at a time.
+
+      For each level and filter tap, the circular shifts of the 
+      'a trous' transforms are precomputed as tables of slices, at 
+      level j (step 2^(j-1)):
+
+        swt:  cA_j[p] = sum_i dec_lo[i]*cA_(j-1)[p - (i - L/2)*step]
+        iswt: cA_(j-1)[p] = 1/2 sum_i (rec_lo[i]*cA_j[p + (L/2 - 1 - i)*step] + 
+                                       rec_hi[i]*cD_j[p + (L/2 - 1 - i)*step])
+
+      (L the filter length, indices modulo the waveform length), 
+      which is the same as swt_block and iswt.  E.g.:
+
+        denoiser = SWTDenoiser('haar', 6, 4096, 0.8, get_threshold_list())
+        denoised = denoiser.denoise(traces, output_buffer)
+    """
+    def __init__(self, wavelet, level, length, scaler=1., thresholds=None,
+                 rows_per_pass=16):
+        if not isinstance(wavelet, pywt.Wavelet):
+            wavelet = pywt.Wavelet(wavelet)
+        if length % 2**level != 0:
+            raise ValueError("Length (%i) must be divisible by 2^level" % length)
+        self.level = level
+        self.length = length
+        self.rows_per_pass = rows_per_pass
+        # Thresholds of each level, as ordered by swt 
+        if thresholds is None: self.thresholds = None
+        else: self.thresholds = [scaler*thresh for thresh in reversed(thresholds[:level])]
+        self.scaler = scaler
+
+        half_length = len(wavelet.dec_lo)//2
+        self.swt_tables = []
+        self.iswt_tables = []
+        for j in range(1, level+1):
+            step_size = 2**(j-1)
+            self.swt_tables.append(
+              [(lo, hi, self.get_shift_slices(-(i - half_length)*step_size))
+               for i, (lo, hi) in enumerate(zip(wavelet.dec_lo, wavelet.dec_hi))])
+            self.iswt_tables.append(
+              [(0.5*lo, 0.5*hi, self.get_shift_slices((half_length - 1 - i)*step_size))
+               for i, (lo, hi) in enumerate(zip(wavelet.rec_lo, wavelet.rec_hi))])
+
+        shape = (rows_per_pass, length)
+        self.cA = numpy.empty(shape)
+        self.next_cA = numpy.empty(shape)
+        self.cD = numpy.empty((level,) + shape)
+        self.scratch = numpy.empty(shape)
+        self.mask = numpy.empty(shape, dtype=bool)
+
+    def get_shift_slices(self, shift):
+        """
+          Pairs of (output, input) slices so that output[p] is
+          input[(p + shift) % length]
+        """
+        shift %= self.length
+        if shift == 0: return [(slice(None), slice(None))]
+        return [(slice(0, self.length - shift), slice(shift, None)),
+                (slice(self.length - shift, None), slice(0, shift))]
+
+    def add_filtered(self, output, data, shift_slices, coefficient):
+        """
+          output[:, p] += coefficient*data[:, (p + shift) % length], 
+          using the buffers
+        """
+        scratch = self.scratch[:output.shape[0]]
+        for output_slice, input_slice in shift_slices:
+            part = scratch[:, output_slice]
+            numpy.multiply(data[:, input_slice], coefficient, out=part)
+            output[:, output_slice] += part
+
+    def threshold(self, cD, j):
+        if self.thresholds is None:
+            # Calculated per waveform, this allocates
+            dev = numpy.median(numpy.abs(cD -
+                    numpy.median(cD, axis=-1)[..., numpy.newaxis]), axis=-1)/0.6745
+            thresh = (math.sqrt(2*math.log(self.length))*dev*self.scaler)[..., numpy.newaxis]
+        else: thresh = self.thresholds[j]
+        rows = cD.shape[0]
+        numpy.abs(cD, out=self.scratch[:rows])
+        numpy.less(self.scratch[:rows], thresh, out=self.mask[:rows])
+        numpy.copyto(cD, 0., where=self.mask[:rows])
+
+    def denoise_pass(self, waveforms, output):
+        rows = waveforms.shape[0]
+        cA = self.cA[:rows]
+        next_cA = self.next_cA[:rows]
+        cA[...] = waveforms
+        for j, table in enumerate(self.swt_tables):
+            cD = self.cD[j, :rows]
+            next_cA.fill(0)
+            cD.fill(0)
+            for lo, hi, table_entry in table:
+                self.add_filtered(next_cA, cA, table_entry, lo)
+                self.add_filtered(cD, cA, table_entry, hi)
+            self.threshold(cD, j)
+            cA, next_cA = next_cA, cA
+
+        for j in range(self.level - 1, -1, -1):
+            cD = self.cD[j, :rows]
+            next_cA.fill(0)
+            for lo, hi, table_entry in self.iswt_tables[j]:
+                self.add_filtered(next_cA, cA, table_entry, lo)
+                self.add_filtered(next_cA, cD, table_entry, hi)
+            cA, next_cA = next_cA, cA
+        output[...] = cA
+
+    def denoise(self, waveforms, output=None):
+        """
+          Denoise waveforms, an array [num_waveforms, length] (it
+          is not modified), into output (allocated if None).
+          Returns output.
+        """
+        if output is None: output = numpy.empty(waveforms.shape)
+        for first in range(0, waveforms.shape[0], self.rows_per_pass):
+            last = first + self.rows_per_pass
+            self.denoise_pass(waveforms[first:last], output[first:last])
+        return output
+
+def get_waveform_array(wf):
+    """
+      Copy the data of an MGTWaveform into a numpy array
+    """
+    return get_waveform_view(wf).copy()
+
+def get_waveform_view(wf):
+    """
+      numpy array sharing the data of an MGTWaveform (no copy).
+      It is only valid as long as the data of wf are unchanged.
+    """
+    data = wf.GetData()
+    data.SetSize(wf.GetLength())
+    return numpy.frombuffer(data, dtype=numpy.float64, count=wf.GetLength())
+
+def estimate_energies(waveforms, sampling_frequency, upper_bandpass=0.0001,
+                      baseline_time=280e3, bandpass=True):
+    """
+      numpy version of the energy estimation in analyze_events,
+      for a block of waveforms ([num_waveforms, length]) at once.
+      Returns the arrays (baseline, maximum, minimum, averagepeak),
+      the values saved in MGMBeGeOneChannelInfo.
+
+      maximum and minimum are the extrema of the raw waveforms.  If
+      bandpass is True (shaped channels), the waveforms are low-pass
+      filtered at upper_bandpass (as MGWFBandpassFilter, dividing
+      out the length) and averagepeak and baseline are calculated
+      from the filtered waveforms.  Otherwise, averagepeak is the
+      maximum.  The baseline is the average over baseline_time.
+    """
+    waveforms = numpy.asarray(waveforms, dtype=float)
+    maximum = waveforms.max(axis=-1)
+    minimum = waveforms.min(axis=-1)
+    num_baseline = int(baseline_time*sampling_frequency)
+    if not bandpass:
+        return (waveforms[..., :num_baseline].mean(axis=-1), 
+                maximum, minimum, maximum)
+
+    filtered = bandpass_waveforms(waveforms, sampling_frequency, upper_bandpass)
+    return (filtered[..., :num_baseline].mean(axis=-1), 
+            maximum, minimum, filtered.max(axis=-1))
+
+def bandpass_waveforms(waveforms, sampling_frequency, upper_bandpass):
+    """
+      Low-pass filter along the last axis, removing all frequencies
+      above upper_bandpass.  This is MGWFBandpassFilter, except that
+      the output is normalized (the transformer output is
+      multiplied by the length of the waveform).
+    """
+    length = waveforms.shape[-1]
+    spectrum = numpy.fft.rfft(waveforms, axis=-1)
+    frequencies = numpy.arange(spectrum.shape[-1])*sampling_frequency/length
+    spectrum[..., frequencies > upper_bandpass] = 0
+    return numpy.fft.irfft(spectrum, length, axis=-1)
+
+def find_bandpass_extrema(waveforms, sampling_frequency, upper_bandpass=0.0001):
+    """
+      numpy version of the bandpass maximum and minimum of the preamp
+      traces in analyze_events, for a block of waveforms.  Returns
+      arrays (maximum, minimum, max_point, min_point), the values
+      are on the (unnormalized) scale of MGWFBandpassFilter.
+    """
+    filtered = bandpass_waveforms(numpy.asarray(waveforms, dtype=float),
+                                  sampling_frequency, upper_bandpass)
+    filtered *= filtered.shape[-1]
+    rows = numpy.arange(len(filtered))
+    max_point = filtered.argmax(axis=-1)
+    min_point = filtered.argmin(axis=-1)
+    return (filtered[rows, max_point], filtered[rows, min_point], 
+            max_point, min_point)
+
+def savitzky_golay_derivative(waveforms, half_width=6):
+    """
+      First derivative (per sample) along the last axis, from a
+      quadratic Savitzky-Golay fit over 2*half_width+1 points, as
+      MGWFSavitzkyGolaySmoother(half_width, 1, 2).  The first and
+      last half_width points are set to 0.
+    """
+    length = waveforms.shape[-1]
+    offsets = numpy.arange(-half_width, half_width+1)
+    coefficients = offsets/float((offsets*offsets).sum())
+    output = numpy.zeros(waveforms.shape)
+    for coefficient, offset in zip(coefficients, offsets):
+        if offset == 0: continue
+        output[..., half_width:length-half_width] += \
+          coefficient*waveforms[..., half_width+offset:length-half_width+offset]
+    return output
+
+def window_average(waveforms, delay_time, window_time, sampling_frequency):
+    """
+      Average of each waveform (row) over [delay_time, 
+      delay_time + window_time), as MGWFStaticWindow with a
+      first ramp time of 0.  delay_time is an array, one per row. 
+    """
+    length = waveforms.shape[-1]
+    first = numpy.clip((delay_time*sampling_frequency).astype(int), 0, length-1)
+    last = ((delay_time + window_time)*sampling_frequency).astype(int)
+    last = numpy.clip(last, first+1, length)
+    sums = numpy.zeros((len(waveforms), length+1))
+    numpy.cumsum(waveforms, axis=-1, out=sums[:, 1:])
+    rows = numpy.arange(len(waveforms))
+    return (sums[rows, last] - sums[rows, first])/(last - first)
+
+def calculate_risetimes(traces, sampling_frequency, pulse_start=100e3, 
+                        length_of_pulse=30e3, initial_percentage=0.1, 
+                        final_percentage=0.9, scan_to_percentage=0.8):
+    """
+      numpy version of the risetime calculation in analyze_events,
+      for a block of denoised traces ([num_traces, length]).
+      Returns the arrays (start, stop, risetime) as from 
+      MGWFRisetimeCalculation (GetInitialThresholdCrossing, ...).
+
+      The same steps are followed, for all traces at once: the
+      window of length_of_pulse after pulse_start is taken, the FWHM
+      region of the derivative around its minimum gives the rise
+      (a 4 mus window around the minimum if there is no region), 
+      the baseline before and the peak height after this are 
+      estimated and the threshold crossings found scanning from
+      the beginning of the baseline estimation.
+    """
+    period = 1./sampling_frequency
+    first = int(pulse_start*sampling_frequency)
+    num_points = int(length_of_pulse*sampling_frequency)
+    waveforms = numpy.asarray(traces, dtype=float)[:, first:first+num_points]
+    num_points = waveforms.shape[-1]
+    rows = numpy.arange(len(waveforms))
+    index = numpy.arange(num_points)
+
+    # Find the minimum of the derivative (FixME, assuming negative going pulse)
+    derivative = savitzky_golay_derivative(waveforms)
+    point = derivative.argmin(axis=-1)
+    threshold = (0.5*derivative[rows, point])[:, numpy.newaxis]
+
+    # The FWHM regions, as MGWFPulseFinder (below a negative 
+    # threshold, above a positive one)
+    in_region = numpy.where(threshold < 0, derivative < threshold, 
+                                           derivative > threshold)
+    has_regions = in_region.any(axis=-1)
+    # The region with the extremum point within, otherwise the first one 
+    seed = numpy.where(in_region[rows, point], point, in_region.argmax(axis=-1))
+    seed = seed[:, numpy.newaxis]
+    outside = ~in_region
+    beginning = numpy.where(outside & (index <= seed), index, -1).max(axis=-1) + 1
+    end = numpy.where(outside & (index >= seed), index, num_points).min(axis=-1) - 1
+
+    # No regions, estimate using the derivative peak, 4 mus window
+    start = numpy.where(has_regions, beginning*period, point*period - 2e3)
+    end = numpy.where(has_regions, end*period, point*period + 2e3)
+
+    # Extend the window to one more full width on each side  
+    diff = (end - start)/2.0 
+    start -= 2*diff
+    end += 2*diff
+
+    # Estimate, subtract baseline using 1 mus integration
+    start = numpy.maximum(start, 0)
+    delay = numpy.where(start < 1e3, start, start - 1e3)
+    waveforms = waveforms - window_average(waveforms, delay, 1e3, 
+                                           sampling_frequency)[:, numpy.newaxis]
+
+    # now grab the peak height
+    end = numpy.minimum(end, length_of_pulse - 1e3)
+    peak = window_average(waveforms, end, 1e3, sampling_frequency)
+
+    # Threshold crossings, working with positive going pulses
+    waveforms *= numpy.where(peak < 0, -1., 1.)[:, numpy.newaxis]
+    height = numpy.abs(peak)[:, numpy.newaxis]
+    scan_from = (start*sampling_frequency).astype(int)[:, numpy.newaxis]
+    after_scan = index >= scan_from
+
+    # Scan forward to the scan_to_percentage ...
+    above = after_scan & (waveforms >= scan_to_percentage*height)
+    scan_to = numpy.where(above.any(axis=-1), above.argmax(axis=-1), num_points-1)
+    scan_to = scan_to[:, numpy.newaxis]
+    # ... back to the initial crossing ...
+    below = after_scan & (index <= scan_to) & (waveforms < initial_percentage*height)
+    initial = numpy.where(below.any(axis=-1), 
+                          numpy.where(below, index, -1).max(axis=-1) + 1, 
+                          scan_from[:, 0])
+    # ... and forward to the final crossing
+    above = (index >= scan_to) & (waveforms >= final_percentage*height)
+    final = numpy.where(above.any(axis=-1), above.argmax(axis=-1), num_points-1)
+
+    start_rt = initial*period
+    stop_rt = final*period
+    return start_rt, stop_rt, stop_rt - start_rt
+
+
+class BinaryEvent:
+    """
+      Holds the waveforms of one trigger decoded from a binary
+      file, with the part of the MGTEvent interface used by
+      analyze_events.
+    """
+    def __init__(self, num_waveforms):
+        self.waveforms = [ROOT.MGTWaveform() for i in range(num_waveforms)]
+    def GetWaveform(self, i): return self.waveforms[i]
+    def GetNWaveforms(self): return len(self.waveforms)
+
+def get_tree_events(the_tree, event, first_entry, last_entry):
+    """
+      Iterate over the entries [first_entry, last_entry) of a
+      soudan_wf_analysis tree, the EventBranch address set to event,
+      yielding the tuples needed by analyze_events.
+    """
+    for entry in range(first_entry, last_entry):
+        # Grab the event from the input tree
+        the_tree.GetEntry(entry)
+        # Pulser flags (combining two flags from initial tree)
+        pulser = ((the_tree.pulser_chunk_two != 0) or (the_tree.pulser_chunk_one != 0))
+        yield event, pulser, the_tree.timestamp
+
+def get_checkpoint_file_name(output_file_name):
+    return output_file_name + ".checkpoint"
+
+def get_checkpoint_input_name(input_file_name):
+    """
+      The name of the input file in a checkpoint, its absolute path
+      so that a run may be resumed from any directory (as parseBeGe
+      does).  URLs (e.g. root://) are left as they are.
+    """
+    if "://" in input_file_name: return input_file_name
+    return os.path.realpath(input_file_name)
+
+def read_checkpoint(checkpoint_file_name):
+    """
+      Return (number of entries processed, input file name) from
+      the checkpoint file, None if it does not exist.  The format
+      is that of the checkpoint of parseBeGe --incremental.
+    """
+    if not os.path.exists(checkpoint_file_name): return None
+    checkpoint = open(checkpoint_file_name)
+    try:
+        lines = checkpoint.read().split("\n")
+    finally:
+        checkpoint.close()
+    return int(lines[0]), lines[1]
+
+def write_checkpoint(checkpoint_file_name, number_processed, input_file_name):
+    """
+      Write the checkpoint, through a temporary file so that it
+      is never left half written.
+    """
+    temp_file_name = checkpoint_file_name + ".tmp"
+    checkpoint = open(temp_file_name, "w")
+    try:
+        checkpoint.write("%i\n%s\n" % (number_processed, 
+                                        get_checkpoint_input_name(input_file_name)))
+    finally:
+        checkpoint.close()
+    os.rename(temp_file_name, checkpoint_file_name)
+
+def process_waveforms_in_file(input_file_name, output_file_name, block_size=256,
+                              first_entry=0, last_entry=None, numpy_energy=False,
+                              numpy_risetime=False, flat_output=False, 
+                              profile_file_name=None, incremental=False, config=None,
+                              features=False, feature_file_name=None):
+    """
+      Analyze the waveforms in the soudan_wf_analysis tree of
+      input_file_name, writing the energy_output_tree.  Events
+      are handled in blocks of block_size so that the preamp
+      traces of a block are denoised together.
 
-def process_waveforms_in_file(input_file_name, output_file_name):
+      Only entries [first_entry, last_entry) are processed, 
+      last_entry = None means up to the end of the tree.
+
+      numpy_energy, numpy_risetime and flat_output are passed to 
+      analyze_events.  If profile_file_name is given, the time of
+      each stage is measured (printing progress lines) and the 
+      summary written to it as JSON (see profiling).
+
+      If incremental is True, the output file is updated instead of
+      recreated: only the entries not yet in its energy_output_tree
+      are analyzed and appended (e.g. for an input file that grows
+      during a run, see parseBeGe --incremental).  The progress is 
+      saved after each block and recorded in the checkpoint file 
+      (see get_checkpoint_file_name), so an interrupted run is 
+      resumed without duplicating or dropping events.
+
+      config is the run configuration (see run_config), a 
+      RunConfiguration or the name of its file.
+
+      If features is True, the feature table of the output (the 
+      values used by the microphonics, LN fill and odd pulse cuts, 
+      see energy_tree_columns.get_event_features) is collected 
+      during the analysis and written to feature_file_name (default:
+      output_file_name with the suffix _features.npz).  When 
+      appending, the table of the earlier entries is extended if it
+      is up to date, otherwise the whole tree is read for it.
+    """
 
     # Initialize, setting the mode to bath to avoid any X connections
     ROOT.gROOT.SetBatch()
@@ -101,10 +676,265 @@ def process_waveforms_in_file(input_file_name, output_file_name):
     event = ROOT.MGTEvent()
     the_tree.SetBranchAddress("EventBranch", event)
 
+    if last_entry is None or last_entry > the_tree.GetEntries(): 
+        last_entry = the_tree.GetEntries()
+
+    block_done = None
+    earlier_features = None
+    if incremental:
+        # Before the output file is updated
+        if features:
+            earlier_features = energy_tree_columns.read_event_features(output_file_name, 
+                                                                       feature_file_name)
+        output_file = ROOT.TFile(output_file_name, "update")
+        # Resume after the entries already in the output.  The tree 
+        # is saved before the checkpoint is written, so the tree may
+        # be ahead of the checkpoint (after a crash) but never behind.
+        output_tree = output_file.Get("energy_output_tree")
+        num_earlier_entries = 0
+        if output_tree: num_earlier_entries = output_tree.GetEntries()
+        resume_entry = first_entry + num_earlier_entries
+        checkpoint_file_name = get_checkpoint_file_name(output_file_name)
+        checkpoint = read_checkpoint(checkpoint_file_name)
+        if checkpoint is not None:
+            number_processed, checkpoint_input_file_name = checkpoint
+            if (get_checkpoint_input_name(checkpoint_input_file_name) != 
+                get_checkpoint_input_name(input_file_name)):
+                raise RuntimeError("Checkpoint is for a different input file: %s" % 
+                                   checkpoint_input_file_name)
+            if number_processed > resume_entry:
+                raise RuntimeError("Output file has fewer entries (%i) than the checkpoint (%i)" %
+                                   (resume_entry, number_processed))
+        if resume_entry > last_entry:
+            raise RuntimeError("Output file has more entries (%i) than the input file (%i)" %
+                               (resume_entry, last_entry))
+        print "Resuming after entry %i, %i new entries" % (resume_entry, 
+                                                           last_entry - resume_entry)
+        if resume_entry == last_entry:
+            output_file.Close()
+            if features: 
+                # Opening for update changed the file, the table is still valid
+                energy_tree_columns.write_event_features(output_file_name, 
+                                                         feature_file_name, 
+                                                         earlier_features)
+            return
+        def block_done(number_done):
+            write_checkpoint(checkpoint_file_name, resume_entry + number_done, 
+                             input_file_name)
+        first_entry = resume_entry
+    else:
+        output_file = ROOT.TFile(output_file_name, "recreate")
+
+    profiler = None
+    if profile_file_name: profiler = profiling.StageProfiler(last_entry - first_entry)
+    event_features = None
+    if features: event_features = energy_tree_columns.EventFeatures()
+
+    analyze_events(get_tree_events(the_tree, event, first_entry, last_entry), 
+                   last_entry - first_entry, output_file, block_size, 
+                   numpy_energy, numpy_risetime, flat_output, profiler, block_done,
+                   config, event_features)
+    output_file.Close()
+    if profiler: profiler.write_summary(profile_file_name)
+    if not features: return
+    table = event_features.get_table()
+    if incremental and num_earlier_entries > 0:
+        if earlier_features is None: 
+            # Not known for the earlier entries, read the whole tree
+            table = None
+        else: 
+            table = energy_tree_columns.merge_event_features([earlier_features, table])
+    energy_tree_columns.write_event_features(output_file_name, feature_file_name, table)
+
+def process_binary_file(binary_file_name, output_file_name, block_size=256,
+                        raw_sample_interval=0, numpy_energy=False, 
+                        numpy_risetime=False, flat_output=False, 
+                        profile_file_name=None, config=None, features=False,
+                        feature_file_name=None):
+    """
+      Analyze the triggers of a raw binary file (as read by parseBeGe)
+      directly, writing only the energy_output_tree.  This skips the
+      intermediate soudan_wf_analysis file.
+
+      If raw_sample_interval is N > 0, the raw waveforms of every 
+      N-th trigger are also saved, in the raw_waveforms tree of the
+      output file (branches waveform_0 ... waveform_5, and entry, 
+      the entry in the energy_output_tree).
+
+      profile_file_name, config, features and feature_file_name are
+      as for process_waveforms_in_file, config also gives the layout
+      of the binary file.
+    """
+    ROOT.gROOT.SetBatch()
+    config = run_config.get_run_configuration(config)
+    num_triggers = bege_binary.get_number_of_triggers(binary_file_name, config)
+
+    profiler = None
+    if profile_file_name: profiler = profiling.StageProfiler(num_triggers)
+
+    output_file = ROOT.TFile(output_file_name, "recreate")
+    num_waveforms = config.num_waveforms_per_trigger
+    event = BinaryEvent(num_waveforms)
+    if raw_sample_interval > 0:
+        raw_tree = ROOT.TTree("raw_waveforms", "Sampled raw waveforms")
+        raw_waveforms = [ROOT.MGTWaveform() for i in range(num_waveforms)]
+        raw_entry = array.array('L', [0])
+        for i, wf in enumerate(raw_waveforms): 
+            raw_tree.Branch("waveform_%i" % i, wf)
+        raw_tree.Branch("entry", raw_entry, "entry/i")
+
+    def binary_events():
+        entry = 0
+        for triggers in bege_binary.iterate_triggers(binary_file_name, block_size, 
+                                                     config=config):
+            for trigger in range(len(triggers)):
+                data = triggers.waveforms[trigger].astype(numpy.float64)
+                for wf, wf_data in zip(event.waveforms, data):
+                    wf.SetSamplingFrequency(config.sampling_frequency)
+                    wf.SetData(wf_data, len(wf_data))
+                if raw_sample_interval > 0 and entry % raw_sample_interval == 0:
+                    # Save before the analysis modifies the waveforms
+                    for wf, wf_data in zip(raw_waveforms, data):
+                        wf.SetSamplingFrequency(config.sampling_frequency)
+                        wf.SetData(wf_data, len(wf_data))
+                    raw_entry[0] = entry
+                    raw_tree.Fill()
+                pulser = ((triggers.pulser_chunk_two[trigger] != 0) or 
+                          (triggers.pulser_chunk_one[trigger] != 0))
+                yield event, pulser, long(triggers.timestamp[trigger])
+                entry += 1
+
+    event_features = None
+    if features: event_features = energy_tree_columns.EventFeatures()
+    analyze_events(binary_events(), num_triggers, output_file, block_size, 
+                   numpy_energy, numpy_risetime, flat_output, profiler, 
+                   config=config, features=event_features)
+    if raw_sample_interval > 0: 
+        output_file.cd()
+        raw_tree.Write()
+    output_file.Close()
+    if profiler: profiler.write_summary(profile_file_name)
+    if features: 
+        energy_tree_columns.write_event_features(output_file_name, feature_file_name,
+                                                 event_features.get_table())
+
+def set_output_branch(output_tree, name, address, leaf_list=None):
+    """
+      Create the branch, or set its address if output_tree 
+      already has it (when appending to an existing tree).
+    """
+    if output_tree.GetBranch(name): 
+        output_tree.SetBranchAddress(name, address)
+    elif leaf_list is None: 
+        output_tree.Branch(name, address)
+    else: 
+        output_tree.Branch(name, address, leaf_list)
+
+def create_flat_branches(output_tree):
+    """
+      Create the branches of the flat layout (see energy_tree_columns)
+      in output_tree, returning the dictionary of numpy buffers 
+      (keyed by branch name) for fill_flat_buffers.
+    """
+    buffers = {}
+    def add_branch(name, size, dtype, leaf_type, size_name=None):
+        buffers[name] = numpy.zeros(size, dtype=dtype)
+        if size_name is not None: leaf = "%s[%s]/%s" % (name, size_name, leaf_type)
+        elif size > 1: leaf = "%s[%i]/%s" % (name, size, leaf_type)
+        else: leaf = "%s/%s" % (name, leaf_type)
+        set_output_branch(output_tree, name, buffers[name], leaf)
+
+    add_branch("num_channels", 1, numpy.uint32, "i")
+    for field in energy_tree_columns.channel_info_fields:
+        add_branch(energy_tree_columns.flat_channel_info_branches[field], 
+                   energy_tree_columns.max_channels, numpy.float64, "D")
+    add_branch("num_risetime_channels", 1, numpy.uint32, "i")
+    for field in energy_tree_columns.risetime_info_fields:
+        if field in ('max_point', 'min_point'): dtype, leaf_type = numpy.uint32, "i"
+        else: dtype, leaf_type = numpy.float64, "D"
+        add_branch(energy_tree_columns.flat_risetime_info_branches[field], 
+                   energy_tree_columns.max_risetime_channels, dtype, leaf_type)
+    add_branch("num_veto_regions", 1, numpy.uint32, "i")
+    add_branch("veto_beginning", energy_tree_columns.max_veto_regions, numpy.uint64, 
+               "l", "num_veto_regions")
+    add_branch("veto_end", energy_tree_columns.max_veto_regions, numpy.uint64, 
+               "l", "num_veto_regions")
+    return buffers
+
+def fill_flat_buffers(buffers, muon_veto, channel_info, risetime):
+    """
+      Copy the values of the analysis objects into the buffers
+      returned by create_flat_branches.  Unused channels are zero.
+    """
+    num_channels = min(channel_info.GetNumChannels(), energy_tree_columns.max_channels)
+    buffers["num_channels"][0] = num_channels
+    for field in energy_tree_columns.channel_info_fields:
+        buffer = buffers[energy_tree_columns.flat_channel_info_branches[field]]
+        buffer.fill(0)
+        for chan in range(num_channels):
+            buffer[chan] = getattr(channel_info.GetChannel(chan), field)
+
+    num_channels = min(risetime.GetNumChannels(), energy_tree_columns.max_risetime_channels)
+    buffers["num_risetime_channels"][0] = num_channels
+    for field in energy_tree_columns.risetime_info_fields:
+        buffer = buffers[energy_tree_columns.flat_risetime_info_branches[field]]
+        buffer.fill(0)
+        for chan in range(num_channels):
+            buffer[chan] = getattr(risetime.GetChannel(chan), field)
+
+    num_regions = muon_veto.GetNumberOfRegions()
+    if num_regions > energy_tree_columns.max_veto_regions:
+        raise RuntimeError("Too many muon veto regions (%i) for the flat output" % 
+                           num_regions)
+    buffers["num_veto_regions"][0] = num_regions
+    for i in range(num_regions):
+        buffers["veto_beginning"][i] = muon_veto.regions[i].beginning
+        buffers["veto_end"][i] = muon_veto.regions[i].end
+
+def analyze_events(events, numEntries, output_file, block_size=256,
+                   numpy_energy=False, numpy_risetime=False, flat_output=False,
+                   profiler=None, block_done=None, config=None, features=None):
+    """
+      Perform the waveform analysis, writing the energy_output_tree
+      into output_file.  events is an iterator over numEntries
+      tuples of (event, pulser_on, timestamp), where event has
+      the MGTEvent interface (GetWaveform, GetNWaveforms).  Each
+      event is used only until the next one is requested.
+
+      If numpy_energy is True, the energy values of the channels
+      are calculated for the whole block with estimate_energies 
+      instead of with the transformers.  Similarly, numpy_risetime 
+      uses find_bandpass_extrema and calculate_risetimes for the
+      preamp traces.
+
+      If flat_output is True, the tree is written in the flat layout
+      (fixed-size array branches, see energy_tree_columns) instead
+      of with the MGMMuonVeto, MGMBeGeChannelInfo and MGMRisetimeInfo
+      objects.  energy_tree_columns.FlatEnergyTree reads it back 
+      with the same interface.
+
+      profiler (see profiling.StageProfiler) accumulates the time
+      of each stage: tree_read, muon_veto, energy, swt_denoise,
+      risetime and tree_fill.
+
+      If output_file already has an energy_output_tree, the events 
+      are appended to it.  block_done, if given, is called after each
+      block with the number of events processed, once the tree has 
+      been saved (AutoSave), e.g. to record a checkpoint.
+
+      config (see run_config) gives the baseline time, the risetime
+      window and the dyadic window of the wavelet denoising, it is 
+      the default configuration if None.
+
+      features (energy_tree_columns.EventFeatures), if given, collects
+      the feature table of the events as they are written.
+    """
+    if profiler is None: profiler = profiling.NullProfiler()
+    config = run_config.get_run_configuration(config)
 
     # Baseline Transformer
     baseline = ROOT.MGWFBaselineRemover()
-    init_baseline_time = 280e3
+    init_baseline_time = config.baseline_time
 
     # Extremum Transformer
     extremum = ROOT.MGWFExtremumFinder()
@@ -137,12 +967,35 @@ def process_waveforms_in_file(input_file_name, output_file_name):
 
     # Parameters for the wavelet transformation
     wl_trans = pywt.Wavelet('haar')
-    level = 6
-    length_of_pulse = 30e3
+    level = config.swt_level
+    length_of_pulse = config.length_of_pulse
+    thresholds = get_threshold_list()
 
-    # Setup objects for writing out, TFile, TTree, etc.
-    output_file = ROOT.TFile(output_file_name, "recreate")
-    output_tree = ROOT.TTree("energy_output_tree", "Soudan Energy Tree")
+    # The preamp traces of a block are copied into preamp_block and 
+    # denoised into denoised_block, these and the buffers of the
+    # denoiser are reused for every block.  Only the dyadic (2^N) 
+    # window of the configuration around the rise is denoised. 
+    preamp_offset = config.swt_window_offset
+    preamp_length = config.swt_window_length
+    denoiser = SWTDenoiser(wl_trans, level, preamp_length, 0.8, thresholds)
+    preamp_block = numpy.empty((2*block_size, preamp_length))
+    denoised_block = numpy.empty((2*block_size, preamp_length))
+    if numpy_risetime:
+        preamp_raw_block = numpy.empty((2*block_size, config.waveform_length))
+    # With numpy_energy, the waveforms of each channel of a block
+    # are copied into these (reused) buffers
+    if numpy_energy:
+        energy_blocks = dict((chan_num, numpy.empty((block_size, config.waveform_length)))
+                             for chan_num in (0,1,2,4,5))
+
+    # Setup objects for writing out, TTree, etc.
+    output_file.cd()
+    output_tree = output_file.Get("energy_output_tree")
+    if output_tree:
+        if energy_tree_columns.is_flat_tree(output_tree) != flat_output:
+            raise RuntimeError("Can not append to an energy_output_tree of the other layout")
+    else:
+        output_tree = ROOT.TTree("energy_output_tree", "Soudan Energy Tree")
 
     # Setup MGMAnalysisClasses to encapsulate the output data
     muon_veto = ROOT.MGMMuonVeto()
@@ -153,15 +1006,17 @@ def process_waveforms_in_file(input_file_name, output_file_name):
     long_array = c_ulonglong*1
     time = long_array()
 
-    output_tree.Branch("muon_veto", muon_veto)
-    output_tree.Branch("channel_info", channel_info)
-    output_tree.Branch("risetime_info", risetime)
-    output_tree.Branch("pulser_on", pulser_on, "pulser_on/i")
-    output_tree.Branch("time", time, "time/l")
+    if flat_output:
+        flat_buffers = create_flat_branches(output_tree)
+    else:
+        set_output_branch(output_tree, "muon_veto", muon_veto)
+        set_output_branch(output_tree, "channel_info", channel_info)
+        set_output_branch(output_tree, "risetime_info", risetime)
+    set_output_branch(output_tree, "pulser_on", pulser_on, "pulser_on/i")
+    set_output_branch(output_tree, "time", time, "time/l")
 
 
     percentageDone = 0
-    numEntries = the_tree.GetEntries()
 
     # The events has waveforms in the following configuration:
     # 0: channel 0, shaped 6 mus, low-energy
@@ -170,210 +1025,571 @@ def process_waveforms_in_file(input_file_name, output_file_name):
     # 3: muon veto 
     # 4: pre-amp trace, low-energy 
     # 5: pre-amp trace, high-energy 
-    for entry in range(numEntries):
-        # Outputting progress, every 10 percent
-        if int(entry*100/numEntries) > 10*percentageDone: 
-          percentageDone += 1
-          print "Done (%): ", percentageDone*10
+    for block_start in range(0, numEntries, block_size):
+        block_entries = range(block_start, min(block_start + block_size, numEntries))
 
-        # Clear the analysis objects
-        muon_veto.regions.clear()
-        channel_info.channels.clear()
-        risetime.channels.clear()
+        # First pass over the block, everything except the wavelet
+        # denoising and the risetime calculation.  The preamp traces
+        # are collected to be denoised together.
+        block_events = []
+        num_preamp_traces = 0
+        num_energy_traces = {}
+        energy_sampling_frequency = {}
+        preamp_sampling_frequency = None
+        for entry in block_entries:
+            # Outputting progress, every 10 percent
+            if int(entry*100/numEntries) > 10*percentageDone: 
+              percentageDone += 1
+              print "Done (%): ", percentageDone*10
 
-        # Grab the event from the input tree
-        the_tree.GetEntry(entry)
-        
-        # Set pulser flags (combining two flags from initial tree)
-        pulser_on[0] = ((the_tree.pulser_chunk_two != 0) or (the_tree.pulser_chunk_one != 0))
-
-        # Set time
-        time[0] = the_tree.timestamp
-
-        # Muon VETO
-        # Use the pulser finder to determine the regions of the 
-        # waveform where the muon veto has fired.
-        pulse_finder.SetThreshold(-0.2) # -0.2 volts, it fires negative
-        pulse_finder.Transform(event.GetWaveform(3))
-        for an_event in pulse_finder.GetThePulseRegions():
-            muon_veto.regions.push_back(an_event)
-
-        # All channels
-        all_channels = [0,1,2,4,5]
-        if event.GetNWaveforms() <= 4: 
-            all_channels = [0,1,2]
-        for chan_num in all_channels:
-            if chan_num >= event.GetNWaveforms(): continue
-            baseline.SetBaselineTime(init_baseline_time) # 250 mus
-            wf = event.GetWaveform(chan_num)
-            extremum.SetFindMaximum(True)
-            extremum.Transform(wf)
-
-            # Find parameter of waveform, max, min, etc.
-            max_value = extremum.GetTheExtremumValue()
-            avg_value = max_value
-            extremum.SetFindMaximum(False)
-            extremum.Transform(wf)
-            min_value = extremum.GetTheExtremumValue()
-            baseline_factor = 1
-            
-            # only process the shaped waveform with a bandpass filter
-            if chan_num in (0,1,2):
-                first_bandpass.Transform(wf)
+            # Grab the next event
+            profiler.start("tree_read")
+            event, pulser, timestamp = events.next()
+            profiler.stop("tree_read")
+
+            # Muon VETO
+            profiler.start("muon_veto")
+            # Use the pulser finder to determine the regions of the 
+            # waveform where the muon veto has fired.
+            pulse_finder.SetThreshold(-0.2) # -0.2 volts, it fires negative
+            pulse_finder.Transform(event.GetWaveform(3))
+            veto_regions = [ROOT.MGWaveformRegion(an_event.beginning, an_event.end)
+                            for an_event in pulse_finder.GetThePulseRegions()]
+            profiler.stop("muon_veto")
+
+            # All channels
+            profiler.start("energy")
+            channels = []
+            all_channels = [0,1,2,4,5]
+            if event.GetNWaveforms() <= 4: 
+                all_channels = [0,1,2]
+            for chan_num in all_channels:
+                if chan_num >= event.GetNWaveforms(): continue
+                if numpy_energy:
+                    # Collect, the values are calculated for the block 
+                    wf = event.GetWaveform(chan_num)
+                    row = num_energy_traces.get(chan_num, 0)
+                    energy_blocks[chan_num][row] = get_waveform_view(wf)
+                    num_energy_traces[chan_num] = row + 1
+                    energy_sampling_frequency[chan_num] = wf.GetSamplingFrequency()
+                    channels.append((chan_num, row))
+                    continue
+                baseline.SetBaselineTime(init_baseline_time) # 250 mus
+                wf = event.GetWaveform(chan_num)
                 extremum.SetFindMaximum(True)
                 extremum.Transform(wf)
-                avg_value = extremum.GetTheExtremumValue()/wf.GetLength()
-                baseline_factor = wf.GetLength()
-            baseline_value = baseline.GetBaseline(wf)/baseline_factor 
 
-            # Save values in channel_info object
-            channel_info.channels.push_back(
-              ROOT.MGMBeGeOneChannelInfo(baseline_value, max_value, min_value, avg_value))
+                # Find parameter of waveform, max, min, etc.
+                max_value = extremum.GetTheExtremumValue()
+                avg_value = max_value
+                extremum.SetFindMaximum(False)
+                extremum.Transform(wf)
+                min_value = extremum.GetTheExtremumValue()
+                baseline_factor = 1
+            
+                # only process the shaped waveform with a bandpass filter
+                if chan_num in (0,1,2):
+                    first_bandpass.Transform(wf)
+                    extremum.SetFindMaximum(True)
+                    extremum.Transform(wf)
+                    avg_value = extremum.GetTheExtremumValue()/wf.GetLength()
+                    baseline_factor = wf.GetLength()
+                baseline_value = baseline.GetBaseline(wf)/baseline_factor 
+
+                channels.append(
+                  ROOT.MGMBeGeOneChannelInfo(baseline_value, max_value, min_value, avg_value))
+            profiler.stop("energy")
         
-        # Preamp trace channels
-        preamp_channels = [4,5]
-        if event.GetNWaveforms() <= preamp_channels[0]: 
-            preamp_channels = []
+            # Preamp trace channels
+            profiler.start("risetime")
+            preamp_channels = [4,5]
+            if event.GetNWaveforms() <= preamp_channels[0]: 
+                preamp_channels = []
             
-        for chan_num in preamp_channels:
-            wf = event.GetWaveform(chan_num)
-
-            # First do a bandpass filter to grab important values
-            # Grab the max and the min
-            first_bandpass.Transform(wf, bandpass_wf)
-            extremum.SetFindMaximum(True)
-            extremum.Transform(bandpass_wf)
-            rise_max = extremum.GetTheExtremumValue() 
-            rise_max_pos = extremum.GetTheExtremumPoint() 
-
-            extremum.SetFindMaximum(False)
-            extremum.Transform(bandpass_wf)
-            rise_min = extremum.GetTheExtremumValue() 
-            rise_min_pos = extremum.GetTheExtremumPoint() 
-
-            # Perform the wavelet smoothing
-            # Get the raw data from the waveform to pass to pywt
-            vec = wf.GetVectorData()
-            # make the waveform a dyadic (2^N) (FixME, we are assuming
-            # the waveform is 8000 entries long)
-            # reduce to length 4096
-            vec.erase(vec.begin(), vec.begin()+3904)
-
-            # Stationary Wavelet Transform
-            output = pywt.swt(vec, wl_trans, level=level)
-            # Thresholding
-            apply_threshold(output, 0.8, get_threshold_list())
-            # Inverse transform
-            cA = iswt(output, wl_trans)
-
-            # Reloading into waveform, but getting a small region around
-            # the known waveform rise to reduce later calculation
-            newwf.SetSamplingFrequency(wf.GetSamplingFrequency())
-            start = int(100e3*wf.GetSamplingFrequency())
-            end = start + int(length_of_pulse*wf.GetSamplingFrequency())
-            # loading waveform from start to end
-            newwf.SetData(cA[start:end], end-start)
-
-            # Now find the risetime
-            # Take the derivative to zero in on the pulse
-            der.Transform(newwf, tempder)
-            # Find minimum (FixME, assuming negative going pulse)
-            extremum.SetFindMaximum(False)
-            extremum.Transform(tempder)
-
-            # Find the FWHM
-            pulse_finder.SetThreshold(0.5*extremum.GetTheExtremumValue())
-            pulse_finder.Transform(tempder)
-
-            point = extremum.GetTheExtremumPoint()
-
-            # Find the correct region in case there are other ones that have been
-            # found.  I.e. this is the one with the extremum point within.
-            regions = pulse_finder.GetThePulseRegions()
-            test_point = 0
-            for region in range(regions.size()):
-                if regions[region].IsInRegion(point):
-                    test_point = region
-                    break
+            preamp_info = []
+            for chan_num in preamp_channels:
+                wf = event.GetWaveform(chan_num)
+                data = get_waveform_view(wf)
+                # Copy the dyadic part for the wavelet smoothing 
+                preamp_block[num_preamp_traces] = data[preamp_offset:preamp_offset+preamp_length]
+                if numpy_risetime:
+                    # Everything is calculated for the block
+                    preamp_raw_block[num_preamp_traces] = data
+                    preamp_sampling_frequency = wf.GetSamplingFrequency()
+                    num_preamp_traces += 1
+                    preamp_info.append((None, None, None, None, wf.GetSamplingFrequency()))
+                    continue
+                num_preamp_traces += 1
+
+                # First do a bandpass filter to grab important values
+                # Grab the max and the min
+                first_bandpass.Transform(wf, bandpass_wf)
+                extremum.SetFindMaximum(True)
+                extremum.Transform(bandpass_wf)
+                rise_max = extremum.GetTheExtremumValue() 
+                rise_max_pos = extremum.GetTheExtremumPoint() 
+
+                extremum.SetFindMaximum(False)
+                extremum.Transform(bandpass_wf)
+                rise_min = extremum.GetTheExtremumValue() 
+                rise_min_pos = extremum.GetTheExtremumPoint() 
+
+                preamp_info.append((rise_max, rise_min, rise_max_pos, rise_min_pos,
+                                    wf.GetSamplingFrequency()))
+            profiler.stop("risetime")
+
+            block_events.append((pulser, timestamp, veto_regions, channels, preamp_info))
+
+        # Perform the wavelet smoothing of the whole block, 
+        # Stationary Wavelet Transform, Thresholding, Inverse transform 
+        if num_preamp_traces:
+            profiler.start("swt_denoise")
+            denoised = denoiser.denoise(preamp_block[:num_preamp_traces], 
+                                        denoised_block[:num_preamp_traces])
+            profiler.stop("swt_denoise")
+            if numpy_risetime:
+                profiler.start("risetime")
+                # Values in the order of MGMRisetimeOneChannelInfo
+                rise_max, rise_min, rise_max_pos, rise_min_pos = \
+                  find_bandpass_extrema(preamp_raw_block[:num_preamp_traces], 
+                                        preamp_sampling_frequency, shaped_bandpass)
+                rise_values = (calculate_risetimes(denoised, preamp_sampling_frequency, 
+                                                   config.pulse_start, length_of_pulse) + 
+                               (rise_max, rise_min, rise_max_pos, rise_min_pos))
+                profiler.stop("risetime")
+
+        # Energy values of the block, for numpy_energy
+        profiler.start("energy")
+        energy_values = {}
+        for chan_num, num_traces in num_energy_traces.items():
+            energy_values[chan_num] = estimate_energies(energy_blocks[chan_num][:num_traces], 
+                                        energy_sampling_frequency[chan_num],
+                                        shaped_bandpass, init_baseline_time,
+                                        bandpass=(chan_num in (0,1,2)))
+        profiler.stop("energy")
+
+        # Second pass over the block, the risetime and filling the tree 
+        trace_index = 0
+        for pulser, timestamp, veto_regions, channels, preamp_info in block_events:
+            # Clear the analysis objects
+            profiler.start("tree_fill")
+            muon_veto.regions.clear()
+            channel_info.channels.clear()
+            risetime.channels.clear()
+
+            pulser_on[0] = pulser
+            time[0] = timestamp
+            for region in veto_regions: 
+                muon_veto.AddRegion(region.beginning, region.end)
+            for chan in channels: 
+                if numpy_energy:
+                    chan_num, row = chan
+                    chan = ROOT.MGMBeGeOneChannelInfo(
+                             *[float(values[row]) for values in energy_values[chan_num]])
+                channel_info.channels.push_back(chan)
+            profiler.stop("tree_fill")
+
+            profiler.start("risetime")
+            for rise_max, rise_min, rise_max_pos, rise_min_pos, sampling_frequency in preamp_info:
+                if numpy_risetime:
+                    values = [values[trace_index] for values in rise_values]
+                    risetime.channels.push_back(
+                      ROOT.MGMRisetimeOneChannelInfo(*([float(value) for value in values[:5]] + 
+                                                       [int(value) for value in values[5:]])))
+                    trace_index += 1
+                    continue
+
+                cA = denoised[trace_index]
+                trace_index += 1
+
+                # Reloading into waveform, but getting a small region around
+                # the known waveform rise to reduce later calculation
+                newwf.SetSamplingFrequency(sampling_frequency)
+                start = config.pulse_start_sample
+                end = start + config.pulse_samples
+                # loading waveform from start to end
+                newwf.SetData(cA[start:end], end-start)
+
+                # Now find the risetime
+                # Take the derivative to zero in on the pulse
+                der.Transform(newwf, tempder)
+                # Find minimum (FixME, assuming negative going pulse)
+                extremum.SetFindMaximum(False)
+                extremum.Transform(tempder)
+
+                # Find the FWHM
+                pulse_finder.SetThreshold(0.5*extremum.GetTheExtremumValue())
+                pulse_finder.Transform(tempder)
+
+                point = extremum.GetTheExtremumPoint()
+
+                # Find the correct region in case there are other ones that have been
+                # found.  I.e. this is the one with the extremum point within.
+                regions = pulse_finder.GetThePulseRegions()
+                test_point = 0
+                for region in range(regions.size()):
+                    if regions[region].IsInRegion(point):
+                        test_point = region
+                        break
     
             
-            if regions.size() == 0:
-                # Means no regions were found (this should never happen, but might 
-                # for a wf close to noise)
-                # Estimate using the derivative peak then
-                # Making a 4 mus window around this point.
-                start = point*newwf.GetSamplingPeriod()-2e3
-                end = point*newwf.GetSamplingPeriod()+2e3 
-            else:
-                # We found the correct point, set the start and stop time
-                # at the FWHM
-                start = regions[test_point].beginning*newwf.GetSamplingPeriod()
-                end = regions[test_point].end*newwf.GetSamplingPeriod()
-            # Gives the HWHM (half-width at half-max)
-            diff = (end - start)/2.0 
-
-            # This extends the window to one more full width on each side  
-            start -= 2*diff
-            end += 2*diff
-
-            # First estimate and subtract the baseline
-            # This check is to make sure we are on the
-            # the waveform still
-            if start < 0: start = 0
-            if start < 1e3: 
-                static_window.SetDelayTime(start)
-            else:
-                static_window.SetDelayTime(start-1e3)
-
-            # Estimate, subtract baseline using 1 mus integration
-            static_window.SetFirstRampTime(0)
-            static_window.SetSecondRampTime(1e3)
-            static_window.Transform(newwf)
-            newwf -= static_window.GetPeakHeight()
+                if regions.size() == 0:
+                    # Means no regions were found (this should never happen, but might 
+                    # for a wf close to noise)
+                    # Estimate using the derivative peak then
+                    # Making a 4 mus window around this point.
+                    start = point*newwf.GetSamplingPeriod()-2e3
+                    end = point*newwf.GetSamplingPeriod()+2e3 
+                else:
+                    # We found the correct point, set the start and stop time
+                    # at the FWHM
+                    start = regions[test_point].beginning*newwf.GetSamplingPeriod()
+                    end = regions[test_point].end*newwf.GetSamplingPeriod()
+                # Gives the HWHM (half-width at half-max)
+                diff = (end - start)/2.0 
+
+                # This extends the window to one more full width on each side  
+                start -= 2*diff
+                end += 2*diff
+
+                # First estimate and subtract the baseline
+                # This check is to make sure we are on the
+                # the waveform still
+                if start < 0: start = 0
+                if start < 1e3: 
+                    static_window.SetDelayTime(start)
+                else:
+                    static_window.SetDelayTime(start-1e3)
+
+                # Estimate, subtract baseline using 1 mus integration
+                static_window.SetFirstRampTime(0)
+                static_window.SetSecondRampTime(1e3)
+                static_window.Transform(newwf)
+                newwf -= static_window.GetPeakHeight()
     
-            # now grab the peak height
-            if end > length_of_pulse - 1e3: end = length_of_pulse - 1e3
-            static_window.SetDelayTime(end)
-            static_window.SetFirstRampTime(0)
-            static_window.SetSecondRampTime(1e3)
-            static_window.Transform(newwf)
+                # now grab the peak height
+                if end > length_of_pulse - 1e3: end = length_of_pulse - 1e3
+                static_window.SetDelayTime(end)
+                static_window.SetFirstRampTime(0)
+                static_window.SetSecondRampTime(1e3)
+                static_window.Transform(newwf)
    
-            # We have the peak height, we feed into the risetime calculator
-            max_value_to_find = static_window.GetPeakHeight()
-            rise.SetPulsePeakHeight(max_value_to_find)
+                # We have the peak height, we feed into the risetime calculator
+                max_value_to_find = static_window.GetPeakHeight()
+                rise.SetPulsePeakHeight(max_value_to_find)
      
-            # Scan from the start position defined by the beginning
-            # of the baseline estimation 
-            rise.SetScanFrom(int(start*newwf.GetSamplingFrequency()))
-            rise.Transform(newwf)
-            rt = rise.GetRiseTime()
-            start_rt = rise.GetInitialThresholdCrossing()
-            stop_rt = rise.GetFinalThresholdCrossing()
-
-            # Save in the MGMAnalysis Object
-            risetime.channels.push_back(
-              ROOT.MGMRisetimeOneChannelInfo(start_rt, stop_rt, rt, 
-                                             rise_max, rise_min,
-                                             int(rise_max_pos), int(rise_min_pos)))
+                # Scan from the start position defined by the beginning
+                # of the baseline estimation 
+                rise.SetScanFrom(int(start*newwf.GetSamplingFrequency()))
+                rise.Transform(newwf)
+                rt = rise.GetRiseTime()
+                start_rt = rise.GetInitialThresholdCrossing()
+                stop_rt = rise.GetFinalThresholdCrossing()
 
-        
-        output_tree.Fill()
+                # Save in the MGMAnalysis Object
+                risetime.channels.push_back(
+                  ROOT.MGMRisetimeOneChannelInfo(start_rt, stop_rt, rt, 
+                                                 rise_max, rise_min,
+                                                 int(rise_max_pos), int(rise_min_pos)))
+            profiler.stop("risetime")
+
+            profiler.start("tree_fill")
+            if flat_output:
+                fill_flat_buffers(flat_buffers, muon_veto, channel_info, risetime)
+            output_tree.Fill()
+            if features is not None: features.add_event(channel_info, risetime, pulser)
+            profiler.stop("tree_fill")
+            profiler.event_done()
+
+        if block_done is not None:
+            output_tree.AutoSave("SaveSelf")
+            block_done(block_entries[-1] + 1)
+    profiler.start("tree_fill")
     output_file.cd()
-    output_tree.Write()
+    output_tree.Write("", ROOT.TObject.kOverwrite)
+    profiler.stop("tree_fill")
+    profiler.finish()
+
+# Largest differences accepted by check_numpy_analysis, the 
+# energies and extrema in V, the times in ns
+numpy_analysis_tolerances = { 'channel_info.baseline' : 1e-6,
+                              'channel_info.maximum' : 1e-6,
+                              'channel_info.minimum' : 1e-6,
+                              'channel_info.averagepeak' : 1e-6,
+                              'risetime_info.start' : 1e-3,
+                              'risetime_info.stop' : 1e-3,
+                              'risetime_info.risetime' : 1e-3,
+                              'risetime_info.maximum' : 1e-6,
+                              'risetime_info.minimum' : 1e-6,
+                              'risetime_info.max_point' : 0,
+                              'risetime_info.min_point' : 0 }
+
+def check_numpy_analysis(input_file_name, num_entries=100, tolerances=None):
+    """
+      Regression check of the numpy analysis (estimate_energies,
+      find_bandpass_extrema and calculate_risetimes) against the 
+      transformers, analyzing the first num_entries of 
+      input_file_name both ways.  Returns a dictionary of the 
+      maximum absolute difference, per channel, of each field of
+      MGMBeGeOneChannelInfo and MGMRisetimeOneChannelInfo, e.g.
+      "channel_info.baseline", "risetime_info.risetime".
+
+      Raises a RuntimeError, listing the fields, if any difference
+      is larger than its tolerance (tolerances updates the defaults,
+      numpy_analysis_tolerances).
+    """
+    all_tolerances = dict(numpy_analysis_tolerances)
+    if tolerances: all_tolerances.update(tolerances)
 
-def main(input_file, output_file):
+    ROOT.gROOT.SetBatch()
+    input_file = ROOT.TFile(input_file_name)
+    the_tree = input_file.Get("soudan_wf_analysis")
+    event = ROOT.MGTEvent()
+    the_tree.SetBranchAddress("EventBranch", event)
+    num_entries = min(num_entries, the_tree.GetEntries())
+
+    columns = []
+    for use_numpy in (False, True):
+        output_file = ROOT.TMemFile("check_numpy_analysis_%i" % use_numpy, "recreate")
+        analyze_events(get_tree_events(the_tree, event, 0, num_entries), 
+                       num_entries, output_file, numpy_energy=use_numpy,
+                       numpy_risetime=use_numpy)
+        columns.append(energy_tree_columns.read_energy_columns(
+                         output_file.Get("energy_output_tree")))
+        output_file.Close()
+
+    differences = {}
+    failed = []
+    keys = (["channel_info." + field for field in energy_tree_columns.channel_info_fields] +
+            ["risetime_info." + field for field in energy_tree_columns.risetime_info_fields])
+    for key in keys:
+        difference = numpy.abs(columns[0][key] - columns[1][key])
+        # A channel missing in only one of the analyses is a difference
+        difference[numpy.isnan(columns[0][key]) != numpy.isnan(columns[1][key])] = numpy.inf
+        difference[numpy.isnan(difference)] = 0
+        differences[key] = difference.max(axis=0)
+        if (differences[key] > all_tolerances[key]).any():
+            failed.append("%s %s (tolerance %g)" % (key, differences[key], all_tolerances[key]))
+    if failed:
+        raise RuntimeError("numpy analysis differs from the transformers: " + 
+                           ", ".join(failed))
+    return differences
+
+def process_chunk(chunk):
+    """
+      Worker function for process_waveforms_in_parallel.  chunk is
+      (input_file_name, output_file_name, block_size, first_entry, last_entry,
+       numpy_energy, numpy_risetime, flat_output, profile_file_name, 
+       incremental, config, features).
+      Returns None on success, otherwise the formatted traceback.
+    """
+    try:
+        process_waveforms_in_file(*chunk)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+def run_chunk_process(chunk, error_file_name):
+    """
+      Target of the process of a chunk: process_chunk, writing the 
+      traceback to error_file_name and exiting with 1 on failure.
+    """
+    error = process_chunk(chunk)
+    if error:
+        error_file = open(error_file_name, "w")
+        try:
+            error_file.write(error)
+        finally:
+            error_file.close()
+        sys.exit(1)
+
+def run_processes(targets, jobs, poll_interval=0.1):
+    """
+      Run each of targets, (function, arguments) tuples, in its own
+      process, at most jobs at a time and started in order.  Returns
+      the exit codes of the processes, negative (-signal) for a 
+      process killed by a signal, e.g. a segfault in ROOT.
+    """
+    pending = list(enumerate(targets))
+    running = {}
+    exit_codes = [None]*len(targets)
+    while pending or running:
+        while pending and len(running) < jobs:
+            i, (function, arguments) = pending.pop(0)
+            running[i] = multiprocessing.Process(target=function, args=arguments)
+            running[i].start()
+        finished = [index for index, process in running.items() if not process.is_alive()]
+        for i in finished:
+            running[i].join()
+            exit_codes[i] = running.pop(i).exitcode
+        if not finished: time.sleep(poll_interval)
+    return exit_codes
+
+def get_exit_code_message(exit_code):
+    if exit_code < 0: return "worker killed by signal %i" % -exit_code
+    return "worker exited with code %i" % exit_code
+
+def process_waveforms_in_parallel(input_file_name, output_file_name, jobs, 
+                                  block_size=256, chunks_per_job=4, numpy_energy=False,
+                                  numpy_risetime=False, flat_output=False,
+                                  profile_file_name=None, config=None, features=False):
+    """
+      Split the entries of the input tree into chunks and process
+      each in its own worker process, jobs at a time (each worker 
+      builds its own transformers in process_waveforms_in_file).  The per-chunk
+      energy_output_trees are then merged, in entry order, into 
+      output_file_name.  The result is the same as a serial run. 
+
+      Raises a RuntimeError if any of the chunks fail, after 
+      reporting the failure of each chunk (the traceback, or the 
+      exit code of a worker that died).
+
+      If profile_file_name is given, the profiles of the chunks
+      are combined (see profiling.merge_summaries) into it.  If 
+      features is True, the feature tables of the chunks are merged
+      into that of the output (see process_waveforms_in_file).
+    """
+    input_file = ROOT.TFile(input_file_name)
+    num_entries = input_file.Get("soudan_wf_analysis").GetEntries()
+    input_file.Close()
+
+    num_chunks = min(jobs*chunks_per_job, num_entries)
+    if jobs <= 1 or num_chunks <= 1:
+        return process_waveforms_in_file(input_file_name, output_file_name, block_size,
+                                         numpy_energy=numpy_energy, 
+                                         numpy_risetime=numpy_risetime,
+                                         flat_output=flat_output,
+                                         profile_file_name=profile_file_name,
+                                         config=config, features=features)
+
+    # Temporary output directory next to the final output
+    temp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_file_name)))
+    try:
+        chunk_size = int(math.ceil(float(num_entries)/num_chunks))
+        chunks = [(input_file_name, 
+                   os.path.join(temp_dir, "chunk_%i.root" % i), 
+                   block_size, first, min(first + chunk_size, num_entries), 
+                   numpy_energy, numpy_risetime, flat_output,
+                   profile_file_name and os.path.join(temp_dir, "chunk_%i.json" % i),
+                   False, config, features)
+                  for i, first in enumerate(range(0, num_entries, chunk_size))]
+
+        # Each chunk in its own process, so that a worker dying (e.g.
+        # a segfault) is reported as the failure of its chunk
+        error_file_names = [os.path.join(temp_dir, "chunk_%i.error" % i) 
+                            for i in range(len(chunks))]
+        exit_codes = run_processes([(run_chunk_process, (chunk, error_file_name))
+                                    for chunk, error_file_name in 
+                                    zip(chunks, error_file_names)], jobs)
+        errors = []
+        for exit_code, error_file_name in zip(exit_codes, error_file_names):
+            if exit_code == 0: errors.append(None)
+            elif os.path.exists(error_file_name): errors.append(open(error_file_name).read())
+            else: errors.append(get_exit_code_message(exit_code))
+
+        failed = [(chunk, error) for chunk, error in zip(chunks, errors) if error]
+        for chunk, error in failed:
+            print "Chunk entries [%i, %i) failed:" % (chunk[3], chunk[4])
+            print error
+        if failed:
+            raise RuntimeError("%i of %i chunks failed" % (len(failed), len(chunks)))
+
+        # Merge the outputs in the original entry order
+        chain = ROOT.TChain("energy_output_tree")
+        for chunk in chunks: chain.Add(chunk[1])
+        chain.Merge(output_file_name)
+        if features:
+            tables = [energy_tree_columns.read_event_features(chunk[1]) for chunk in chunks]
+            energy_tree_columns.write_event_features(
+              output_file_name, columns=energy_tree_columns.merge_event_features(tables))
+
+        if profile_file_name:
+            summaries = [json.load(open(chunk[8])) for chunk in chunks]
+            profiling.write_summary(profiling.merge_summaries(summaries), profile_file_name)
+    finally:
+        shutil.rmtree(temp_dir)
+
+def main(input_file, output_file, jobs=1, binary=False, raw_sample_interval=0,
+         numpy_energy=False, numpy_risetime=False, flat_output=False,
+         profile_file_name=None, incremental=False, config=None, features=False):
     # For usage when directly imported
-    process_waveforms_in_file(input_file, output_file) 
+    if binary and incremental:
+        raise RuntimeError("The incremental mode is not available for binary files")
+    if binary:
+        process_binary_file(input_file, output_file, 
+                            raw_sample_interval=raw_sample_interval,
+                            numpy_energy=numpy_energy, 
+                            numpy_risetime=numpy_risetime,
+                            flat_output=flat_output,
+                            profile_file_name=profile_file_name,
+                            config=config, features=features)
+    elif jobs > 1 and not incremental:
+        process_waveforms_in_parallel(input_file, output_file, jobs, 
+                                      numpy_energy=numpy_energy,
+                                      numpy_risetime=numpy_risetime,
+                                      flat_output=flat_output,
+                                      profile_file_name=profile_file_name,
+                                      config=config, features=features) 
+    else:
+        process_waveforms_in_file(input_file, output_file, numpy_energy=numpy_energy,
+                                  numpy_risetime=numpy_risetime, 
+                                  flat_output=flat_output,
+                                  profile_file_name=profile_file_name,
+                                  incremental=incremental,
+                                  config=config, features=features) 
 
 Usage = \
 """
 Usage:
-analyze_waveforms.py [input_root_file] [output_root_file]
+analyze_waveforms.py [options] [input_root_file] [output_root_file]
+analyze_waveforms.py --binary [options] [input_binary_file] [output_root_file]
+analyze_waveforms.py --check-numpy N [input_root_file]
 """
 
 if __name__ == '__main__':
    
-    if len(sys.argv) != 3:
+    parser = optparse.OptionParser(usage=Usage)
+    parser.add_option("-j", "--jobs", type="int", default=1, 
+                      help="number of worker processes (default 1)")
+    parser.add_option("-b", "--binary", action="store_true", default=False,
+                      help="analyze a raw binary file directly")
+    parser.add_option("-r", "--keep-raw", type="int", default=0, metavar="N",
+                      help="with --binary, save the raw waveforms of every N-th trigger")
+    parser.add_option("-e", "--numpy-energy", action="store_true", default=False,
+                      help="calculate the channel energies with numpy (estimate_energies)")
+    parser.add_option("-t", "--numpy-risetime", action="store_true", default=False,
+                      help="calculate the risetimes with numpy (calculate_risetimes)")
+    parser.add_option("-f", "--flat", action="store_true", default=False,
+                      help="write the flat (array branch) layout of the output tree")
+    parser.add_option("-p", "--profile", metavar="FILE",
+                      help="time each stage, writing the summary (json) to FILE")
+    parser.add_option("-i", "--incremental", action="store_true", default=False,
+                      help="append only the new entries to the output file (not with --binary, "
+                           "runs with one job)")
+    parser.add_option("-c", "--config", metavar="FILE",
+                      help="run configuration file (layout and analysis windows, "
+                           "see run_config.py)")
+    parser.add_option("--check-numpy", type="int", default=0, metavar="N",
+                      help="only check the numpy analysis against the transformers on "
+                           "the first N entries of the input file")
+    parser.add_option("-F", "--features", action="store_true", default=False,
+                      help="also write the feature table of the cuts (output_features.npz)")
+    options, args = parser.parse_args()
+    if options.check_numpy > 0 and len(args) == 1:
+        try:
+            differences = check_numpy_analysis(args[0], options.check_numpy)
+        except RuntimeError, error:
+            print error
+            sys.exit(1)
+        for key in sorted(differences): print key, differences[key]
+        sys.exit(0)
+    if len(args) != 2:
         print Usage;
         sys.exit(1)
-    main(sys.argv[1], sys.argv[2])
+    try:
+        main(args[0], args[1], options.jobs, options.binary, options.keep_raw,
+             options.numpy_energy, options.numpy_risetime, options.flat, 
+             options.profile, options.incremental, options.config, options.features)
+    except RuntimeError, error:
+        print error
+        sys.exit(1)
@@ -0,0 +1,440 @@
+#!/usr/local/bin/python
+"""
+  Batch analysis of many runs with a pool of warm worker processes:
+  each worker sets up ROOT (batch mode, the MGM/MGDO dictionaries,
+  optionally a macro such as LoadMGMClasses.C) once and then
+  analyzes run after run, e.g.:
+
+    batch_analysis.py -j 8 output_dir 'runs/*.root'
+    batch_analysis.py -j 8 --binary output_dir 'raw/*.bin'
+    batch_analysis.py -j 8 --parse-bege ../ParseBeGeData/parseBeGe \\
+                      output_dir 'raw/*.bin'
+
+  The runs are given as file names or glob patterns (quoted, so
+  that long lists do not hit the shell limits) and/or in list
+  files (-l, one name per line).  They are scheduled largest first,
+  so that a big run does not start last and leave the other workers
+  idle.  The output of run.root (or run.bin) is
+  output_dir/run_energy.root, with --parse-bege the parsed tree
+  is output_dir/run.root.  Runs with the same name (e.g. from two
+  directories) are rejected, they would write the same output.
+
+  With --features, the feature table of the cuts is also written
+  (output_dir/run_energy_features.npz, see energy_tree_columns).
+
+  A run is skipped when its outputs are newer than its input (and
+  the run configuration file), unless --force is given.  Outputs
+  are written under a temporary name and renamed when complete, so
+  an interrupted batch is simply started again.
+
+  The manifest (output_dir/manifest.json by default) records the
+  status (done, skipped or failed), timing and error of each run,
+  it is rewritten as each run finishes.  A worker that dies (e.g.
+  a segfault in ROOT) fails its run and is replaced.
+"""
+import ROOT
+import os
+import sys
+import glob
+import json
+import time
+import optparse
+import subprocess
+import traceback
+import multiprocessing
+import analyze_waveforms
+import energy_tree_columns
+import profiling
+import run_config
+
+def get_input_file_names(patterns, list_file_names=()):
+    """
+      Expand the glob patterns and read the list files (one name
+      per line, '#' starts a comment), returning the file names in
+      order without duplicates.  Raises a RuntimeError if a
+      pattern matches nothing.
+    """
+    patterns = list(patterns)
+    all_names = []
+    for list_file_name in list_file_names:
+        list_file = open(list_file_name)
+        try:
+            for line in list_file:
+                line = line.split("#")[0].strip()
+                if line: patterns.append(line)
+        finally:
+            list_file.close()
+    for pattern in patterns:
+        names = sorted(glob.glob(pattern))
+        if not names:
+            raise RuntimeError("No input files match: %s" % pattern)
+        all_names.extend(names)
+    seen = set()
+    file_names = []
+    for name in all_names:
+        if name in seen: continue
+        seen.add(name)
+        file_names.append(name)
+    return file_names
+
+def get_output_file_names(input_file_name, output_dir, parse=False):
+    """
+      Return (parsed_file_name, output_file_name) of a run,
+      parsed_file_name is None if the run is not parsed first.
+    """
+    stem = os.path.splitext(os.path.basename(input_file_name))[0]
+    parsed_file_name = None
+    if parse: parsed_file_name = os.path.join(output_dir, stem + ".root")
+    return parsed_file_name, os.path.join(output_dir, stem + "_energy.root")
+
+def is_up_to_date(output_file_name, dependencies):
+    """
+      True if output_file_name exists, is newer than all the
+      dependencies and is not an unfinished incremental output
+      (with a checkpoint file).
+    """
+    if not os.path.exists(output_file_name): return False
+    checkpoint_file_name = analyze_waveforms.get_checkpoint_file_name(output_file_name)
+    if os.path.exists(checkpoint_file_name): return False
+    output_time = os.path.getmtime(output_file_name)
+    for dependency in dependencies:
+        if os.path.getmtime(dependency) > output_time: return False
+    return True
+
+def init_worker(macro_file_name=None):
+    """
+      Set up a worker process: ROOT in batch mode and the
+      dictionaries of the classes used by the analysis loaded,
+      once for all the runs it analyzes.
+    """
+    ROOT.gROOT.SetBatch()
+    if macro_file_name: ROOT.gROOT.Macro(macro_file_name)
+    warm_up = [ROOT.MGTEvent(), ROOT.MGTWaveform(), ROOT.MGMMuonVeto(),
+               ROOT.MGMBeGeChannelInfo(), ROOT.MGMRisetimeInfo(),
+               ROOT.MGWFBaselineRemover(), ROOT.MGWFExtremumFinder(),
+               ROOT.MGWFPulseFinder(), ROOT.MGWFBandpassFilter(),
+               ROOT.MGWFRisetimeCalculation(), ROOT.MGWFStaticWindow(),
+               ROOT.MGWFSavitzkyGolaySmoother(6, 1, 2)]
+    del warm_up
+
+def run_parse_bege(parse_bege, binary_file_name, parsed_file_name, config_file_name=None):
+    """
+      Run the parseBeGe executable, raising a RuntimeError (with
+      its output) if it fails.
+    """
+    command = [parse_bege]
+    if config_file_name: command += ["-c", config_file_name]
+    command += [binary_file_name, parsed_file_name]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        raise RuntimeError("%s failed (%i):\n%s" %
+                           (" ".join(command), process.returncode, output))
+
+def get_number_of_entries(output_file_name):
+    output_file = ROOT.TFile(output_file_name)
+    try:
+        return output_file.Get("energy_output_tree").GetEntries()
+    finally:
+        output_file.Close()
+
+def get_run_record(run, worker=None):
+    """
+      The record of run in the manifest, before it is analyzed
+    """
+    record = dict((key, run[key]) for key in ('input', 'output', 'parsed', 'size'))
+    record['worker'] = worker or os.getpid()
+    return record
+
+def analyze_run(run):
+    """
+      Worker function of process_runs.  run is the dictionary
+      of the run (see process_runs), the record of the manifest
+      is returned with the status, times and error (traceback)
+      filled in.
+    """
+    record = get_run_record(run)
+    start_wall = time.time()
+    start_cpu = profiling.get_cpu_time()
+    try:
+        input_file_name = run['input']
+        if run['parsed'] and not run['parsed_up_to_date']:
+            temp_file_name = run['parsed'] + ".part"
+            run_parse_bege(run['parse_bege'], input_file_name, temp_file_name,
+                           run['config_file_name'])
+            os.rename(temp_file_name, run['parsed'])
+        if run['parsed']: input_file_name = run['parsed']
+        temp_file_name = run['output'] + ".part"
+        # The feature table is collected during the analysis, it is
+        # still valid for the output after the rename
+        feature_file_name = energy_tree_columns.get_feature_file_name(run['output'])
+        if run['binary']:
+            analyze_waveforms.process_binary_file(input_file_name, temp_file_name,
+                                                  numpy_energy=run['numpy_energy'],
+                                                  numpy_risetime=run['numpy_risetime'],
+                                                  flat_output=run['flat_output'],
+                                                  config=run['config'],
+                                                  features=run['features'],
+                                                  feature_file_name=feature_file_name)
+        else:
+            analyze_waveforms.process_waveforms_in_file(input_file_name, temp_file_name,
+                                                        numpy_energy=run['numpy_energy'],
+                                                        numpy_risetime=run['numpy_risetime'],
+                                                        flat_output=run['flat_output'],
+                                                        config=run['config'],
+                                                        features=run['features'],
+                                                        feature_file_name=feature_file_name)
+        record['events'] = get_number_of_entries(temp_file_name)
+        os.rename(temp_file_name, run['output'])
+        record['status'] = 'done'
+    except Exception:
+        record['status'] = 'failed'
+        record['error'] = traceback.format_exc()
+    record['wall_time'] = time.time() - start_wall
+    record['cpu_time'] = profiling.get_cpu_time() - start_cpu
+    # Peak of the worker so far, over all the runs it analyzed
+    record['peak_rss_mb'] = profiling.get_peak_rss()
+    return record
+
+def run_worker(connection, macro_file_name=None):
+    """
+      Loop of a worker process of process_runs: set up once (see
+      init_worker), then analyze each run received on connection,
+      sending back its record, until None is received.
+    """
+    init_worker(macro_file_name)
+    while True:
+        run = connection.recv()
+        if run is None: break
+        connection.send(analyze_run(run))
+
+class BatchWorker:
+    """
+      A worker process of process_runs and the run it is analyzing
+      (None when idle).  The runs and records go through a pipe, so
+      that the parent knows which run a worker that dies was on.
+    """
+    def __init__(self, macro_file_name=None):
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=run_worker,
+                                               args=(worker_connection, macro_file_name))
+        self.process.start()
+        worker_connection.close()
+        self.run = None
+        self.start_time = None
+
+    def start_run(self, run):
+        self.run = run
+        self.start_time = time.time()
+        self.connection.send(run)
+
+    def get_record(self):
+        """
+          The record of the current run if it is finished, a 
+          failure record if the worker died, None otherwise.
+        """
+        try:
+            if self.connection.poll(): return self.connection.recv()
+        except EOFError:
+            # The worker died, its end of the pipe is closed
+            self.process.join()
+        if self.process.is_alive(): return None
+        record = get_run_record(self.run, self.process.pid)
+        record['status'] = 'failed'
+        record['error'] = analyze_waveforms.get_exit_code_message(self.process.exitcode)
+        record['wall_time'] = time.time() - self.start_time
+        return record
+
+    def stop(self):
+        if self.process.is_alive():
+            if self.run is None: self.connection.send(None)
+            else: self.process.terminate()
+        self.process.join()
+
+def write_manifest(manifest, manifest_file_name):
+    """
+      Write the manifest (json), through a temporary file so that
+      it is never left half written.
+    """
+    temp_file_name = manifest_file_name + ".tmp"
+    output = open(temp_file_name, "w")
+    try:
+        json.dump(manifest, output, indent=2, sort_keys=True)
+    finally:
+        output.close()
+    os.rename(temp_file_name, manifest_file_name)
+
+def process_runs(input_file_names, output_dir, jobs=None, binary=False, parse_bege=None,
+                 numpy_energy=False, numpy_risetime=False, flat_output=False,
+                 config=None, force=False, manifest_file_name=None, macro_file_name=None,
+                 features=False, poll_interval=0.1):
+    """
+      Analyze the runs (input_file_names) into output_dir, with
+      jobs worker processes (default: the number of cores).
+
+      The inputs are soudan_wf_analysis files, raw binary files
+      analyzed directly if binary is True, or raw binary files
+      parsed first with the parseBeGe executable given by
+      parse_bege.  numpy_energy, numpy_risetime, flat_output and
+      config are as for analyze_waveforms.analyze_events,
+      macro_file_name is a ROOT macro run once in each worker.
+      If features is True, the feature table of each output is 
+      also written (see energy_tree_columns.write_event_features).
+
+      Runs with up to date outputs are skipped unless force is
+      True.  Raises a RuntimeError, before analyzing anything, if 
+      two runs would write the same output (e.g. dirA/run1.root and
+      dirB/run1.root).  Returns the manifest, also written to
+      manifest_file_name (default output_dir/manifest.json).
+      Raises a RuntimeError if any of the runs fail, after all the
+      other runs are done and the failures reported.
+    """
+    if binary and parse_bege:
+        raise RuntimeError("Use either --binary or --parse-bege")
+    if jobs is None: jobs = multiprocessing.cpu_count()
+    if manifest_file_name is None:
+        manifest_file_name = os.path.join(output_dir, "manifest.json")
+    if not os.path.isdir(output_dir): os.makedirs(output_dir)
+
+    # Read the configuration once, the file is a dependency of the outputs
+    config_file_name = None
+    if config is not None and not isinstance(config, run_config.RunConfiguration):
+        config_file_name = config
+    config = run_config.get_run_configuration(config)
+
+    runs = []
+    skipped = []
+    output_inputs = {}
+    for input_file_name in input_file_names:
+        parsed_file_name, output_file_name = get_output_file_names(
+                                               input_file_name, output_dir,
+                                               parse_bege is not None)
+        for name in (parsed_file_name, output_file_name):
+            if name is None: continue
+            other = output_inputs.setdefault(os.path.abspath(name), input_file_name)
+            if other != input_file_name:
+                raise RuntimeError("%s and %s would both write %s" % 
+                                   (other, input_file_name, name))
+        if os.path.abspath(input_file_name) in (os.path.abspath(output_file_name),
+              parsed_file_name and os.path.abspath(parsed_file_name)):
+            raise RuntimeError("Output would overwrite the input: %s" % input_file_name)
+        run = { 'input' : input_file_name,
+                'parsed' : parsed_file_name,
+                'output' : output_file_name,
+                'size' : os.path.getsize(input_file_name),
+                'binary' : binary,
+                'parse_bege' : parse_bege,
+                'config' : config,
+                'config_file_name' : config_file_name,
+                'numpy_energy' : numpy_energy,
+                'numpy_risetime' : numpy_risetime,
+                'flat_output' : flat_output,
+                'features' : features }
+        dependencies = [input_file_name]
+        if config_file_name: dependencies.append(config_file_name)
+        run['parsed_up_to_date'] = (not force and parsed_file_name is not None and
+                                    is_up_to_date(parsed_file_name, dependencies))
+        if parsed_file_name: dependencies.append(parsed_file_name)
+        if (not force and (parsed_file_name is None or run['parsed_up_to_date']) and
+            is_up_to_date(output_file_name, dependencies) and
+            (not features or is_up_to_date(
+               energy_tree_columns.get_feature_file_name(output_file_name), 
+               [output_file_name]))):
+            skipped.append({ 'input' : input_file_name, 'parsed' : parsed_file_name,
+                             'output' : output_file_name, 'size' : run['size'],
+                             'status' : 'skipped' })
+        else:
+            runs.append(run)
+
+    # Largest first, the pool hands them out in this order
+    runs.sort(key=lambda run: run['size'], reverse=True)
+    print "%i runs, %i up to date, %i to analyze with %i jobs" % \
+      (len(input_file_names), len(skipped), len(runs), jobs)
+
+    start = time.time()
+    manifest = { 'jobs' : jobs, 'runs' : skipped, 'wall_time' : 0. }
+    write_manifest(manifest, manifest_file_name)
+    pending = list(runs)
+    workers = []
+    try:
+        for i in range(min(jobs, len(pending))):
+            workers.append(BatchWorker(macro_file_name))
+            workers[-1].start_run(pending.pop(0))
+        while any(worker.run is not None for worker in workers):
+            finished = False
+            for i, worker in enumerate(workers):
+                if worker.run is None: continue
+                result = worker.get_record()
+                if result is None: continue
+                finished = True
+                worker.run = None
+                manifest['runs'].append(result)
+                manifest['wall_time'] = time.time() - start
+                write_manifest(manifest, manifest_file_name)
+                print "%s: %s (%.1f s)" % (result['input'], result['status'],
+                                           result['wall_time'])
+                if not pending: continue
+                if not worker.process.is_alive():
+                    # Died (e.g. a segfault in ROOT), replace it
+                    worker.process.join()
+                    worker = workers[i] = BatchWorker(macro_file_name)
+                worker.start_run(pending.pop(0))
+            if not finished: time.sleep(poll_interval)
+    finally:
+        for worker in workers: worker.stop()
+
+    failed = [record for record in manifest['runs'] if record['status'] == 'failed']
+    for record in failed:
+        print "Run %s failed:" % record['input']
+        print record['error']
+    if failed:
+        raise RuntimeError("%i of %i runs failed, see %s" %
+                           (len(failed), len(runs), manifest_file_name))
+    return manifest
+
+Usage = \
+"""
+Usage:
+batch_analysis.py [options] output_dir [input_file_or_pattern ...]
+"""
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser(usage=Usage)
+    parser.add_option("-j", "--jobs", type="int",
+                      help="number of worker processes (default: number of cores)")
+    parser.add_option("-l", "--list", action="append", default=[], metavar="FILE",
+                      help="file with the input files, one per line (may be repeated)")
+    parser.add_option("-b", "--binary", action="store_true", default=False,
+                      help="the inputs are raw binary files, analyzed directly")
+    parser.add_option("-P", "--parse-bege", metavar="EXECUTABLE",
+                      help="the inputs are raw binary files, parsed first with EXECUTABLE")
+    parser.add_option("-e", "--numpy-energy", action="store_true", default=False,
+                      help="calculate the channel energies with numpy (estimate_energies)")
+    parser.add_option("-t", "--numpy-risetime", action="store_true", default=False,
+                      help="calculate the risetimes with numpy (calculate_risetimes)")
+    parser.add_option("-f", "--flat", action="store_true", default=False,
+                      help="write the flat (array branch) layout of the output tree")
+    parser.add_option("-c", "--config", metavar="FILE",
+                      help="run configuration file (see run_config.py)")
+    parser.add_option("-F", "--features", action="store_true", default=False,
+                      help="also write the feature table of the cuts of each run")
+    parser.add_option("-m", "--manifest", metavar="FILE",
+                      help="manifest file (default: output_dir/manifest.json)")
+    parser.add_option("-L", "--load-macro", metavar="FILE",
+                      help="ROOT macro run once in each worker, e.g. LoadMGMClasses.C")
+    parser.add_option("--force", action="store_true", default=False,
+                      help="analyze all the runs, also those with up to date outputs")
+    options, args = parser.parse_args()
+    if len(args) < 1 or (len(args) < 2 and not options.list):
+        print Usage;
+        sys.exit(1)
+    try:
+        input_file_names = get_input_file_names(args[1:], options.list)
+        process_runs(input_file_names, args[0], options.jobs, options.binary,
+                     options.parse_bege, options.numpy_energy, options.numpy_risetime,
+                     options.flat, options.config, options.force, options.manifest,
+                     options.load_macro, options.features)
+    except RuntimeError, error:
+        print error
+        sys.exit(1)
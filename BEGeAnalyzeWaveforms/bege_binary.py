@@ -0,0 +1,145 @@
+"""
+  numpy decoding of the raw Soudan BeGe binary files, following
+  the same record layout as ParseBeGeData/parseBeGe.cc.  Each
+  trigger is (big-endian, 32-bit words):
+
+    chan 0, chan 1 interleaved         (2*8000 floats)
+    datetime (2 floats), pulser chunk one, pulser chunk two
+    chan 2, muon veto interleaved      (2*8000 floats)
+    preamp 1, preamp 2 interleaved     (2*8000 floats)
+
+  The file is memory-mapped and whole blocks of triggers are
+  byte-swapped and de-interleaved at once, e.g.:
+
+    data = read_triggers("run.bin", first=0, count=1000)
+    data.waveforms.shape -> (1000, 6, 8000)
+
+  Other layouts (e.g. longer traces) are given with a 
+  run_config.RunConfiguration (or the name of its file), the
+  config argument of the functions.  The constants below are 
+  those of the default layout.
+"""
+import os
+import numpy
+import run_config
+
+_default = run_config.default_configuration
+waveform_length = _default.waveform_length
+num_waveforms_per_trigger = _default.num_waveforms_per_trigger
+sampling_frequency = _default.sampling_frequency # in the CLHEP units of MGDO
+extra_words = _default.extra_words
+words_per_waveform_pair = _default.words_per_waveform_pair
+words_per_trigger = _default.words_per_trigger
+trigger_event_size_in_bytes = _default.trigger_event_size_in_bytes
+
+class BeGeTriggers:
+    """
+      Decoded block of triggers:
+        waveforms : float32 array [events, 6, waveform_length]
+        timestamp : uint64 array [events]
+        pulser_chunk_one, pulser_chunk_two : uint32 arrays [events]
+    """
+    def __init__(self, waveforms, timestamp, pulser_chunk_one, pulser_chunk_two):
+        self.waveforms = waveforms
+        self.timestamp = timestamp
+        self.pulser_chunk_one = pulser_chunk_one
+        self.pulser_chunk_two = pulser_chunk_two
+
+    def __len__(self): return len(self.timestamp)
+
+def get_number_of_triggers(file_name, config=None):
+    """
+      Return the number of triggers in the file, raising a
+      ValueError if the file size is not a multiple of the
+      trigger size (the file is corrupted).
+    """
+    config = run_config.get_run_configuration(config)
+    size_of_file = os.path.getsize(file_name)
+    if size_of_file % config.trigger_event_size_in_bytes != 0:
+        raise ValueError("File corrupted: %s" % file_name)
+    return size_of_file//config.trigger_event_size_in_bytes
+
+def decode_triggers(raw, config=None):
+    """
+      Decode raw, a big-endian uint32 array of shape
+      [events, words_per_trigger], into a BeGeTriggers.
+    """
+    config = run_config.get_run_configuration(config)
+    as_float = raw.view('>f4')
+    waveforms = numpy.empty((len(raw), config.num_waveforms_per_trigger, 
+                             config.waveform_length), dtype=numpy.float32)
+    # Position of each waveform pair in the record
+    for pair, first in enumerate(config.pair_word_offsets):
+        block = as_float[:, first:first + config.words_per_waveform_pair]
+        # The assignment de-interleaves and swaps to native order
+        waveforms[:, 2*pair, :] = block[:, 0::2]
+        waveforms[:, 2*pair + 1, :] = block[:, 1::2]
+
+    # The extra words follow the first waveform pair
+    extra = config.extra_word_offset
+    datetime = (as_float[:, extra].astype(numpy.float64)*1e7).astype(numpy.uint64) + \
+                as_float[:, extra+1].astype(numpy.float64).astype(numpy.uint64)
+    pulser_chunk_one = raw[:, extra+2].astype(numpy.uint32)
+    pulser_chunk_two = raw[:, extra+3].astype(numpy.uint32)
+    return BeGeTriggers(waveforms, datetime, pulser_chunk_one, pulser_chunk_two)
+
+def encode_triggers(triggers, config=None):
+    """
+      Inverse of decode_triggers, returning the big-endian uint32
+      array [events, words_per_trigger] of a BeGeTriggers.  The
+      timestamp is split as datetime = (timestamp/1e7, timestamp%1e7).
+    """
+    config = run_config.get_run_configuration(config)
+    num_triggers = len(triggers)
+    as_float = numpy.zeros((num_triggers, config.words_per_trigger), dtype='>f4')
+    for pair, first in enumerate(config.pair_word_offsets):
+        block = as_float[:, first:first + config.words_per_waveform_pair]
+        block[:, 0::2] = triggers.waveforms[:, 2*pair, :]
+        block[:, 1::2] = triggers.waveforms[:, 2*pair + 1, :]
+
+    extra = config.extra_word_offset
+    timestamp = numpy.asarray(triggers.timestamp, dtype=numpy.uint64)
+    as_float[:, extra] = timestamp//10000000
+    as_float[:, extra+1] = timestamp%10000000
+    raw = as_float.view('>u4')
+    raw[:, extra+2] = triggers.pulser_chunk_one
+    raw[:, extra+3] = triggers.pulser_chunk_two
+    return raw
+
+def write_triggers(file_name, triggers, append=False, config=None):
+    """
+      Write (or append) a BeGeTriggers to file_name in the raw
+      binary format.
+    """
+    output = open(file_name, "ab" if append else "wb")
+    try:
+        encode_triggers(triggers, config).tofile(output)
+    finally:
+        output.close()
+
+def read_triggers(file_name, first=0, count=None, config=None):
+    """
+      Read and decode triggers [first, first+count) of file_name.
+      count = None reads to the end of the file.
+    """
+    config = run_config.get_run_configuration(config)
+    number_of_triggers = get_number_of_triggers(file_name, config)
+    if count is None or first + count > number_of_triggers:
+        count = max(number_of_triggers - first, 0)
+    if count == 0:
+        return decode_triggers(numpy.empty((0, config.words_per_trigger), dtype='>u4'),
+                               config)
+    raw = numpy.memmap(file_name, dtype='>u4', mode='r',
+                       offset=first*config.trigger_event_size_in_bytes,
+                       shape=(count, config.words_per_trigger))
+    return decode_triggers(raw, config)
+
+def iterate_triggers(file_name, triggers_per_read=256, first=0, config=None):
+    """
+      Generator over the file, yielding a BeGeTriggers for
+      each block of (at most) triggers_per_read triggers.
+    """
+    config = run_config.get_run_configuration(config)
+    number_of_triggers = get_number_of_triggers(file_name, config)
+    for start in range(first, number_of_triggers, triggers_per_read):
+        yield read_triggers(file_name, start, triggers_per_read, config)
@@ -0,0 +1,370 @@
+#!/usr/local/bin/python
+"""
+  Benchmarks of the BeGe processing stages on synthetic data, so
+  that no detector data is needed.  Triggers are generated in the
+  raw binary layout (6 waveforms of 8000 samples at 20 MHz, see
+  bege_binary) with shaped and preamp pulses, noise, pulser flags
+  and muon veto hits, and each stage reports events/second and
+  its peak memory (each stage is run in its own process):
+
+    benchmark.py -n 2000 --save baseline.json
+    ... change something ...
+    benchmark.py -n 2000 --compare baseline.json
+
+  The stages are:
+    decode            bege_binary.read_triggers (the numpy decoding)
+    parseBeGe         the parseBeGe executable (--parse-bege)
+    swt               pywt.swt of each preamp trace
+    apply_threshold   apply_threshold of each preamp trace
+    iswt              iswt of each preamp trace
+    denoise_waveforms the block version of the three above
+    swt_denoiser      SWTDenoiser.denoise, with reused buffers
+    process_binary    process_binary_file
+    process_waveforms process_waveforms_in_file, on the parseBeGe output
+    selector_tree     MGMBegeAnalysisSelector.get_all_cuts_list
+    selector_columns  MGMBegeAnalysisSelector.get_all_cuts_mask
+  The wavelet stages count preamp traces (two per trigger) as
+  events.  The selector stages use the cut function snapshot given
+  with --cut-file (see all_bege_mgm_cuts.save_cut_functions), 
+  otherwise synthetic cut functions (see all_bege_mgm_cuts.LocalCutServer).
+  Stages that can not be run (e.g. parseBeGe without --parse-bege)
+  are reported as skipped.
+"""
+import ROOT
+import os
+import sys
+import time
+import json
+import numpy
+import pywt
+import resource
+import optparse
+import shutil
+import subprocess
+import tempfile
+import multiprocessing
+import bege_binary
+import energy_tree_columns
+import analyze_waveforms
+import run_config
+
+all_stages = ['decode', 'parseBeGe', 'swt', 'apply_threshold', 'iswt',
+              'denoise_waveforms', 'swt_denoiser', 'process_binary', 'process_waveforms',
+              'selector_tree', 'selector_columns']
+
+# What each stage that may be skipped needs
+stage_requirements = { 'parseBeGe' : "the parseBeGe executable (--parse-bege)",
+                       'process_waveforms' : "the parseBeGe stage",
+                       'selector_tree' : "the process_binary stage",
+                       'selector_columns' : "the process_binary stage" }
+
+def shaped_pulse(times, peaking_time):
+    """
+      Semi-gaussian (CR-RC^4) pulse of unit height, peaking at
+      peaking_time, times and peaking_time in samples.
+    """
+    order = 4
+    tau = peaking_time/float(order)
+    x = numpy.clip(times, 0, None)/tau
+    return (x/order)**order*numpy.exp(order - x)
+
+def preamp_pulse(times, risetime, decay_time=1000.):
+    """
+      Negative going preamp step, 10-90% risetime and decay_time
+      in samples.
+    """
+    # the logistic function rises 10-90% in 2*ln(9) time constants
+    rise = 1./(1. + numpy.exp(-numpy.clip(times*2*numpy.log(9.)/risetime, -50, 50)))
+    return -rise*numpy.exp(-numpy.clip(times, 0, None)/decay_time)
+
+def generate_triggers(num_triggers, seed=0, first_timestamp=10**13,
+                      veto_rate=0.05, pulser_rate=0.05, noise=0.002):
+    """
+      Generate num_triggers synthetic triggers, returning a
+      bege_binary.BeGeTriggers.  The trigger time is around
+      sample 6200, after the 280 mus of baseline and inside the
+      window used for the risetime.  The rate of muon veto hits
+      and pulser events are veto_rate and pulser_rate, noise is
+      the gaussian noise (V) of each sample.
+    """
+    rng = numpy.random.RandomState(seed)
+    length = bege_binary.waveform_length
+    times = numpy.arange(length)[numpy.newaxis, :]
+
+    amplitude = numpy.clip(rng.exponential(0.03, num_triggers), 0.001, 1.)
+    amplitude = amplitude[:, numpy.newaxis]
+    trigger_time = (6200 + rng.randint(-30, 30, num_triggers))[:, numpy.newaxis]
+    risetime = rng.uniform(4., 16., num_triggers)[:, numpy.newaxis]
+    offset = rng.uniform(-0.012, -0.009, num_triggers)[:, numpy.newaxis]
+
+    waveforms = rng.normal(0., noise,
+                           (num_triggers, bege_binary.num_waveforms_per_trigger, length))
+    # shaped channels, 6 mus and 10 mus, the high-energy one with less gain
+    waveforms[:, 0, :] += offset + amplitude*shaped_pulse(times - trigger_time, 120.)
+    waveforms[:, 1, :] += offset + amplitude*shaped_pulse(times - trigger_time, 200.)
+    waveforms[:, 2, :] += offset + 0.1*amplitude*shaped_pulse(times - trigger_time, 200.)
+
+    # muon veto, negative pulses of 1-5 mus
+    waveforms[:, 3, :] *= 0.1
+    for trigger in numpy.flatnonzero(rng.rand(num_triggers) < veto_rate):
+        start = rng.randint(0, length - 100)
+        waveforms[trigger, 3, start:start + rng.randint(20, 100)] -= 1.
+
+    # preamp traces
+    step = preamp_pulse(times - trigger_time, risetime)
+    waveforms[:, 4, :] += amplitude*step
+    waveforms[:, 5, :] += 0.1*amplitude*step
+
+    timestamp = first_timestamp + numpy.cumsum(
+                  rng.exponential(1e6, num_triggers)).astype(numpy.uint64)
+    pulser_chunk_one = (rng.rand(num_triggers) < pulser_rate).astype(numpy.uint32)
+    pulser_chunk_two = numpy.zeros(num_triggers, dtype=numpy.uint32)
+    return bege_binary.BeGeTriggers(waveforms.astype(numpy.float32), timestamp,
+                                    pulser_chunk_one, pulser_chunk_two)
+
+def write_synthetic_file(file_name, num_triggers, seed=0, triggers_per_write=64):
+    """
+      Write num_triggers synthetic triggers to file_name, in the
+      raw binary format, a block at a time.
+    """
+    for first in range(0, num_triggers, triggers_per_write):
+        triggers = generate_triggers(min(triggers_per_write, num_triggers - first),
+                                     seed + first, 10**13 + first*10**7)
+        bege_binary.write_triggers(file_name, triggers, append=(first > 0))
+
+def write_synthetic_cut_functions(file_name, percentage):
+    """
+      Write the cut functions of all_bege_mgm_cuts.LocalCutServer,
+      including percentage, as a snapshot for MGMBegeAnalysisSelector
+      (cut_file).
+    """
+    import all_bege_mgm_cuts
+    server = all_bege_mgm_cuts.LocalCutServer(sorted(set([80, 90, 95, percentage])))
+    all_bege_mgm_cuts.save_cut_functions(file_name, server)
+
+def get_peak_memory():
+    """
+      Peak resident memory of this process, in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+def get_preamp_traces(binary_file_name, num_traces):
+    """
+      The dyadic windows of the preamp traces, as analyze_events
+      denoises them
+    """
+    config = run_config.default_configuration
+    first = config.swt_window_offset
+    triggers = bege_binary.read_triggers(binary_file_name, 0, (num_traces + 1)//2)
+    traces = triggers.waveforms[:, 4:6, first:first + config.swt_window_length]
+    traces = traces.astype(numpy.float64)
+    return traces.reshape(-1, traces.shape[-1])[:num_traces]
+
+def benchmark_wavelet_stage(stage, binary_file_name, num_traces):
+    traces = get_preamp_traces(binary_file_name, num_traces)
+    wavelet = pywt.Wavelet('haar')
+    level = 6
+    thresholds = analyze_waveforms.get_threshold_list()
+    if stage == 'denoise_waveforms':
+        start = time.time()
+        analyze_waveforms.denoise_waveforms(traces, wavelet, level, 0.8, thresholds)
+        return len(traces), time.time() - start
+    if stage == 'swt_denoiser':
+        denoiser = analyze_waveforms.SWTDenoiser(wavelet, level, traces.shape[-1],
+                                                 0.8, thresholds)
+        output = numpy.empty(traces.shape)
+        start = time.time()
+        denoiser.denoise(traces, output)
+        return len(traces), time.time() - start
+
+    timings = {'swt' : 0., 'apply_threshold' : 0., 'iswt' : 0.}
+    for trace in traces:
+        start = time.time()
+        coefficients = pywt.swt(trace, wavelet, level)
+        timings['swt'] += time.time() - start
+        if stage == 'swt': continue
+        start = time.time()
+        analyze_waveforms.apply_threshold(coefficients, 0.8, thresholds)
+        timings['apply_threshold'] += time.time() - start
+        if stage == 'apply_threshold': continue
+        start = time.time()
+        analyze_waveforms.iswt(coefficients, wavelet)
+        timings['iswt'] += time.time() - start
+    return len(traces), timings[stage]
+
+def run_stage(stage, work_dir, binary_file_name, num_events, options):
+    """
+      Run one stage, returning (events, seconds), or None if the
+      stage can not be run with the given options.
+    """
+    parsed_file_name = os.path.join(work_dir, "parsed.root")
+    energy_file_name = os.path.join(work_dir, "energy.root")
+    if stage == 'decode':
+        start = time.time()
+        for triggers in bege_binary.iterate_triggers(binary_file_name, 64):
+            pass
+        return num_events, time.time() - start
+
+    if stage == 'parseBeGe':
+        if not options.parse_bege: return None
+        start = time.time()
+        output = open(os.devnull, "w")
+        try:
+            subprocess.check_call([options.parse_bege, binary_file_name, parsed_file_name],
+                                  stdout=output)
+        finally:
+            output.close()
+        return num_events, time.time() - start
+
+    if stage in ('swt', 'apply_threshold', 'iswt', 'denoise_waveforms', 'swt_denoiser'):
+        return benchmark_wavelet_stage(stage, binary_file_name,
+                                       min(2*num_events, options.num_traces))
+
+    if stage == 'process_binary':
+        start = time.time()
+        analyze_waveforms.process_binary_file(binary_file_name, energy_file_name)
+        return num_events, time.time() - start
+
+    if stage == 'process_waveforms':
+        if not os.path.exists(parsed_file_name): return None
+        start = time.time()
+        analyze_waveforms.process_waveforms_in_file(parsed_file_name,
+                                                    os.path.join(work_dir, "energy_2.root"))
+        return num_events, time.time() - start
+
+    if stage in ('selector_tree', 'selector_columns'):
+        if not os.path.exists(energy_file_name): return None
+        import all_bege_mgm_cuts
+        cut_file = options.cut_file
+        if not cut_file:
+            cut_file = os.path.join(work_dir, "synthetic_cuts.pkl")
+            write_synthetic_cut_functions(cut_file, options.percentage)
+        selector = all_bege_mgm_cuts.MGMBegeAnalysisSelector(options.percentage,
+                                                             cut_file)
+        open_file = ROOT.TFile(energy_file_name)
+        tree = open_file.Get("energy_output_tree")
+        if stage == 'selector_tree':
+            start = time.time()
+            selector.get_all_cuts_list(tree)
+        else:
+            columns = energy_tree_columns.read_energy_columns(tree)
+            start = time.time()
+            selector.get_all_cuts_mask(columns)
+        seconds = time.time() - start
+        open_file.Close()
+        return num_events, seconds
+    raise ValueError("Unknown stage: %s" % stage)
+
+def stage_process(queue, stage, work_dir, binary_file_name, num_events, options):
+    """
+      Run a stage in a child process, putting (result, initial
+      memory, peak memory) or the error into queue
+    """
+    try:
+        ROOT.gROOT.SetBatch()
+        initial_memory = get_peak_memory()
+        result = run_stage(stage, work_dir, binary_file_name, num_events, options)
+        queue.put((result, initial_memory, get_peak_memory()))
+    except Exception, error:
+        queue.put(error)
+
+def run_benchmarks(num_events, stages=all_stages, options=None, seed=0):
+    """
+      Generate num_events synthetic triggers and run stages,
+      returning a dictionary, per stage, of events, seconds,
+      events_per_second, peak_memory_mb and memory_increase_mb
+      (peak memory over that at the start of the stage).
+      options are those of the command line (see main).
+    """
+    if options is None: options = get_option_parser().get_default_values()
+    work_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        binary_file_name = os.path.join(work_dir, "synthetic.bin")
+        write_synthetic_file(binary_file_name, num_events, seed)
+        for stage in stages:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=stage_process,
+                        args=(queue, stage, work_dir, binary_file_name, num_events, options))
+            process.start()
+            output = queue.get()
+            process.join()
+            if isinstance(output, Exception):
+                raise RuntimeError("Stage %s failed: %s" % (stage, output))
+            result, initial_memory, peak_memory = output
+            if result is None: 
+                print "Skipped stage %s, it needs %s" % (stage, stage_requirements[stage])
+                continue
+            events, seconds = result
+            results[stage] = { 'events' : events,
+                               'seconds' : seconds,
+                               'events_per_second' : events/max(seconds, 1e-9),
+                               'peak_memory_mb' : peak_memory,
+                               'memory_increase_mb' : peak_memory - initial_memory }
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+def print_results(results, baseline=None):
+    """
+      Print the results, with the speed-up compared to baseline
+      (results of an earlier run) if given.
+    """
+    header = "%-18s %8s %10s %12s %10s" % ("stage", "events", "seconds",
+                                           "events/s", "peak MB")
+    if baseline: header += " %9s" % "speed-up"
+    print header
+    for stage in all_stages:
+        if stage not in results: continue
+        result = results[stage]
+        line = "%-18s %8i %10.3f %12.1f %10.1f" % (stage, result['events'],
+                  result['seconds'], result['events_per_second'],
+                  result['peak_memory_mb'])
+        if baseline and stage in baseline:
+            line += " %9.2f" % (result['events_per_second']/
+                                baseline[stage]['events_per_second'])
+        print line
+
+def get_option_parser():
+    parser = optparse.OptionParser(usage="benchmark.py [options]")
+    parser.add_option("-n", "--events", type="int", default=1000,
+                      help="number of synthetic triggers (default 1000)")
+    parser.add_option("-s", "--stages", default=",".join(all_stages),
+                      help="comma separated list of stages (default all)")
+    parser.add_option("--seed", type="int", default=0,
+                      help="random seed of the synthetic data")
+    parser.add_option("--num-traces", type="int", default=1000,
+                      help="maximum number of preamp traces for the wavelet stages")
+    parser.add_option("--parse-bege", metavar="EXECUTABLE",
+                      help="path to parseBeGe, for the parseBeGe and process_waveforms stages")
+    parser.add_option("--cut-file",
+                      help="cut function snapshot for the selector stages (default: synthetic)")
+    parser.add_option("--percentage", type="int", default=90,
+                      help="risetime cut percentage of the selector (default 90)")
+    parser.add_option("--save", metavar="FILE", help="save the results (json) to FILE")
+    parser.add_option("--compare", metavar="FILE",
+                      help="compare to the results (json) saved in FILE")
+    return parser
+
+def main():
+    options, args = get_option_parser().parse_args()
+    stages = options.stages.split(",")
+    for stage in stages:
+        if stage not in all_stages:
+            print "Unknown stage: %s" % stage
+            sys.exit(1)
+    baseline = None
+    if options.compare: baseline = json.load(open(options.compare))
+    results = run_benchmarks(options.events, stages, options, options.seed)
+    print_results(results, baseline)
+    if options.save:
+        output = open(options.save, "w")
+        json.dump(results, output, indent=2, sort_keys=True)
+        output.close()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except RuntimeError, error:
+        print error
+        sys.exit(1)
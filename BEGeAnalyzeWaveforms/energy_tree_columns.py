@@ -0,0 +1,408 @@
+"""
+  Columnar access to the energy_output_tree written by
+  analyze_waveforms.py.  The tree is read once and every field
+  of channel_info and risetime_info is stored as a numpy
+  array of shape [num_entries, num_channels], e.g.:
+
+    columns = load_energy_columns("run.root")
+    energy = (columns["channel_info.averagepeak"][:,1] -
+              columns["channel_info.baseline"][:,1])
+
+  Channels missing in an entry are filled with NaN (e.g. events
+  without preamp traces).  pulser_on and time are 1-d arrays.
+
+  The tree may also be written in the flat layout (see 
+  analyze_waveforms.analyze_events, flat_output), with fixed-size
+  array branches instead of the MGM objects:
+
+    num_channels, baseline[5], maximum[5], minimum[5], averagepeak[5]
+    num_risetime_channels, rise_start[2], rise_stop[2], risetime[2], 
+      rise_maximum[2], rise_minimum[2], max_point[2], min_point[2]
+    num_veto_regions, veto_beginning[num_veto_regions], 
+      veto_end[num_veto_regions]
+
+  FlatEnergyTree gives the object interface (GetChannel(i), ...) 
+  for such a tree.
+
+  For tuning the microphonics, LN fill and odd pulse cuts only a 
+  few derived values per event are needed, the feature table (see
+  get_event_features), which is kept in a small sidecar file:
+
+    features = load_event_features("run.root")
+    features["energy_ratio"]
+
+  analyze_waveforms collects the feature table while it writes the
+  tree (EventFeatures, with --features), so it is not read again.
+"""
+import ROOT
+import os
+import numpy
+
+channel_info_fields = ('baseline', 'maximum', 'minimum', 'averagepeak')
+risetime_info_fields = ('start', 'stop', 'risetime',
+                        'maximum', 'minimum', 'max_point', 'min_point')
+
+# The flat layout, branch names of each field
+max_channels = 5
+max_risetime_channels = 2
+max_veto_regions = 4000
+flat_channel_info_branches = dict((field, field) for field in channel_info_fields)
+flat_risetime_info_branches = { 'start' : 'rise_start', 
+                                'stop' : 'rise_stop', 
+                                'risetime' : 'risetime', 
+                                'maximum' : 'rise_maximum', 
+                                'minimum' : 'rise_minimum', 
+                                'max_point' : 'max_point', 
+                                'min_point' : 'min_point' }
+
+def is_flat_tree(tree):
+    return bool(tree.GetBranch("num_channels"))
+
+class FlatChannel:
+    """
+      One channel of a flat tree entry, the fields are attributes
+      as in MGMBeGeOneChannelInfo/MGMRisetimeOneChannelInfo.
+    """
+    def __init__(self, values, chan):
+        for field, column in values: setattr(self, field, column[chan])
+
+class FlatChannelInfo:
+    """
+      Adapter giving the MGMBeGeChannelInfo/MGMRisetimeInfo interface
+      for the arrays of a flat tree entry.
+    """
+    def __init__(self, values, num_channels):
+        self.values = values
+        self.num_channels = num_channels
+    def GetChannel(self, i): 
+        if i >= self.GetNumChannels(): raise IndexError(i)
+        return FlatChannel(self.values, i)
+    def __getitem__(self, i): return self.GetChannel(i)
+    def GetNumChannels(self): return int(self.num_channels[0])
+    def size(self): return self.GetNumChannels()
+
+class FlatEnergyTree:
+    """
+      Wraps an energy_output_tree in the flat layout so that, after 
+      GetEntry, channel_info, risetime_info, muon_veto, pulser_on and 
+      time can be used as with the object layout, e.g. for
+      MGMBegeAnalysisSelector:
+
+        tree = FlatEnergyTree(open_file.Get("energy_output_tree"))
+        tree.GetEntry(i)
+        tree.channel_info.GetChannel(1).averagepeak
+    """
+    def __init__(self, tree):
+        self.tree = tree
+        self.buffers = {}
+        def add_buffer(name, size, dtype):
+            self.buffers[name] = numpy.zeros(size, dtype=dtype)
+            tree.SetBranchAddress(name, self.buffers[name])
+        add_buffer("num_channels", 1, numpy.uint32)
+        add_buffer("num_risetime_channels", 1, numpy.uint32)
+        add_buffer("num_veto_regions", 1, numpy.uint32)
+        add_buffer("pulser_on", 1, numpy.uint32)
+        add_buffer("time", 1, numpy.uint64)
+        add_buffer("veto_beginning", max_veto_regions, numpy.uint64)
+        add_buffer("veto_end", max_veto_regions, numpy.uint64)
+        channel_values = []
+        for field in channel_info_fields:
+            add_buffer(flat_channel_info_branches[field], max_channels, numpy.float64)
+            channel_values.append((field, self.buffers[flat_channel_info_branches[field]]))
+        risetime_values = []
+        for field in risetime_info_fields:
+            dtype = numpy.uint32 if field in ('max_point', 'min_point') else numpy.float64
+            add_buffer(flat_risetime_info_branches[field], max_risetime_channels, dtype)
+            risetime_values.append((field, self.buffers[flat_risetime_info_branches[field]]))
+        self.channel_info = FlatChannelInfo(channel_values, self.buffers["num_channels"])
+        self.risetime_info = FlatChannelInfo(risetime_values, 
+                                             self.buffers["num_risetime_channels"])
+        self.muon_veto = ROOT.MGMMuonVeto()
+
+    def GetEntries(self): return self.tree.GetEntries()
+
+    def GetEntry(self, i):
+        result = self.tree.GetEntry(i)
+        self.pulser_on = int(self.buffers["pulser_on"][0])
+        self.time = long(self.buffers["time"][0])
+        self.muon_veto.regions.clear()
+        for j in range(self.buffers["num_veto_regions"][0]):
+            self.muon_veto.AddRegion(int(self.buffers["veto_beginning"][j]),
+                                     int(self.buffers["veto_end"][j]))
+        return result
+
+def read_flat_energy_columns(tree):
+    """
+      read_energy_columns for a tree in the flat layout.  Only the
+      needed branches are read, directly into numpy buffers.
+    """
+    num_entries = tree.GetEntries()
+    tree.SetBranchStatus("*", 0)
+    buffers = {}
+    columns = {}
+    def add_column(key, name, size, dtype):
+        tree.SetBranchStatus(name, 1)
+        buffers[key] = numpy.zeros(size, dtype=dtype)
+        tree.SetBranchAddress(name, buffers[key])
+        if size == 1: columns[key] = numpy.zeros(num_entries, dtype=dtype)
+        else: columns[key] = numpy.zeros((num_entries, size))
+    add_column("num_channels", "num_channels", 1, numpy.uint32)
+    add_column("num_risetime_channels", "num_risetime_channels", 1, numpy.uint32)
+    add_column("pulser_on", "pulser_on", 1, numpy.uint32)
+    add_column("time", "time", 1, numpy.uint64)
+    for field in channel_info_fields:
+        add_column("channel_info." + field, flat_channel_info_branches[field], 
+                   max_channels, numpy.float64)
+    for field in risetime_info_fields:
+        dtype = numpy.uint32 if field in ('max_point', 'min_point') else numpy.float64
+        add_column("risetime_info." + field, flat_risetime_info_branches[field], 
+                   max_risetime_channels, dtype)
+
+    for i in range(num_entries):
+        tree.GetEntry(i)
+        for key, buffer in buffers.items(): columns[key][i] = buffer
+    tree.SetBranchStatus("*", 1)
+    tree.ResetBranchAddresses()
+
+    # Channels missing in an entry are NaN, as for the object layout
+    index = numpy.arange(max_channels)
+    missing = index >= columns.pop("num_channels")[:, numpy.newaxis]
+    for field in channel_info_fields: columns["channel_info." + field][missing] = numpy.nan
+    index = numpy.arange(max_risetime_channels)
+    missing = index >= columns.pop("num_risetime_channels")[:, numpy.newaxis]
+    for field in risetime_info_fields: columns["risetime_info." + field][missing] = numpy.nan
+    return columns
+
+def read_energy_columns(tree, num_channels=5, num_risetime_channels=2):
+    """
+      Read the tree (energy_output_tree) once, returning
+      a dictionary of numpy arrays.
+    """
+    if is_flat_tree(tree): return read_flat_energy_columns(tree)
+    num_entries = tree.GetEntries()
+    columns = {}
+    for field in channel_info_fields:
+        columns["channel_info." + field] = numpy.empty((num_entries, num_channels))
+        columns["channel_info." + field].fill(numpy.nan)
+    for field in risetime_info_fields:
+        columns["risetime_info." + field] = numpy.empty((num_entries, num_risetime_channels))
+        columns["risetime_info." + field].fill(numpy.nan)
+    columns["pulser_on"] = numpy.zeros(num_entries, dtype=numpy.uint32)
+    columns["time"] = numpy.zeros(num_entries, dtype=numpy.uint64)
+
+    channel_columns = [(field, columns["channel_info." + field])
+                       for field in channel_info_fields]
+    risetime_columns = [(field, columns["risetime_info." + field])
+                        for field in risetime_info_fields]
+    for i in range(num_entries):
+        tree.GetEntry(i)
+        channel_info = tree.channel_info
+        for chan in range(min(channel_info.GetNumChannels(), num_channels)):
+            achan = channel_info.GetChannel(chan)
+            for field, column in channel_columns:
+                column[i, chan] = getattr(achan, field)
+        risetime_info = tree.risetime_info
+        for chan in range(min(risetime_info.GetNumChannels(), num_risetime_channels)):
+            achan = risetime_info.GetChannel(chan)
+            for field, column in risetime_columns:
+                column[i, chan] = getattr(achan, field)
+        columns["pulser_on"][i] = tree.pulser_on
+        columns["time"][i] = tree.time
+    return columns
+
+def get_cache_file_name(file_name):
+    """
+      Default name of the sidecar file, run.root -> run_columns.npz
+    """
+    return os.path.splitext(file_name)[0] + "_columns.npz"
+
+def get_source_id(file_name):
+    """
+      (size, modification time in ns) of file_name, identifying the
+      version a sidecar file was made from
+    """
+    stat = os.stat(file_name)
+    return numpy.array([stat.st_size, int(round(stat.st_mtime*1e9))], dtype=numpy.int64)
+
+def get_tree_id(open_file):
+    """
+      (UUID of the TFile, entries of its energy_output_tree).  The 
+      UUID is new for each file written, e.g. for a re-analysis that
+      gives a file of the same size.
+    """
+    return (open_file.GetUUID().AsString(), 
+            open_file.Get("energy_output_tree").GetEntries())
+
+def load_energy_columns(file_name, cache_file_name=None, use_cache=True):
+    """
+      Return the columns of the energy_output_tree in file_name.
+
+      If use_cache is True, the columns are taken from the sidecar
+      file (cache_file_name, see get_cache_file_name for the default)
+      when it was made from the same version of file_name, otherwise
+      the tree is read and the sidecar file (re)written.
+    """
+    if cache_file_name is None:
+        cache_file_name = get_cache_file_name(file_name)
+    source_id = get_source_id(file_name)
+
+    if use_cache and os.path.exists(cache_file_name):
+        cache = numpy.load(cache_file_name)
+        if numpy.array_equal(cache["source_id"], source_id):
+            return dict((key, cache[key]) for key in cache.files if key != "source_id")
+
+    open_file = ROOT.TFile(file_name)
+    columns = read_energy_columns(open_file.Get("energy_output_tree"))
+    open_file.Close()
+
+    if use_cache:
+        numpy.savez_compressed(cache_file_name, source_id=source_id, **columns)
+    return columns
+
+# Derived values of each event, in the feature table
+event_feature_names = ('energy_1', 'energy_ratio', 'rise_max_min', 
+                       'minimum_1', 'baseline_1', 'pulser_on')
+
+def get_event_features(columns):
+    """
+      The feature table of the columns, a dictionary of 1-d arrays
+      in entry order:
+        entry          entry in the energy_output_tree
+        energy_1       averagepeak - baseline of channel 1
+        energy_ratio   energy of channel 0 / energy_1
+        rise_max_min   maximum - minimum of risetime channel 1
+        minimum_1, baseline_1   of channel 1
+        pulser_on
+      A feature table is returned as it is.
+    """
+    if "energy_ratio" in columns: return columns
+    energy_0 = columns["channel_info.averagepeak"][:,0] - columns["channel_info.baseline"][:,0]
+    energy_1 = columns["channel_info.averagepeak"][:,1] - columns["channel_info.baseline"][:,1]
+    old_settings = numpy.seterr(divide='ignore', invalid='ignore')
+    energy_ratio = energy_0/energy_1
+    numpy.seterr(**old_settings)
+    return { 'entry' : numpy.arange(len(energy_1), dtype=numpy.uint32),
+             'energy_1' : energy_1,
+             'energy_ratio' : energy_ratio,
+             'rise_max_min' : (columns["risetime_info.maximum"][:,1] - 
+                               columns["risetime_info.minimum"][:,1]),
+             'minimum_1' : columns["channel_info.minimum"][:,1],
+             'baseline_1' : columns["channel_info.baseline"][:,1],
+             'pulser_on' : columns["pulser_on"] }
+
+def get_feature_file_name(file_name):
+    """
+      Default name of the feature table, run.root -> run_features.npz
+    """
+    return os.path.splitext(file_name)[0] + "_features.npz"
+
+def write_event_features(file_name, feature_file_name=None, columns=None):
+    """
+      Write the feature table of the energy_output_tree in file_name
+      to feature_file_name (see get_feature_file_name for the 
+      default), with the source id and UUID of file_name.  The table
+      is computed from columns (or columns may be the feature table,
+      e.g. from EventFeatures), the tree is only read if columns is
+      None.  Returns the table.
+    """
+    if feature_file_name is None:
+        feature_file_name = get_feature_file_name(file_name)
+    source_id = get_source_id(file_name)
+    open_file = ROOT.TFile(file_name)
+    uuid, num_entries = get_tree_id(open_file)
+    if columns is None:
+        columns = read_energy_columns(open_file.Get("energy_output_tree"))
+    open_file.Close()
+    features = get_event_features(columns)
+    if len(features["entry"]) != num_entries:
+        raise ValueError("Feature table has %i entries, the tree %i" % 
+                         (len(features["entry"]), num_entries))
+    numpy.savez_compressed(feature_file_name, source_id=source_id, 
+                           uuid=numpy.array(uuid), **features)
+    return features
+
+def read_event_features(file_name, feature_file_name=None):
+    """
+      The feature table of file_name from feature_file_name, None 
+      if there is none for this version of file_name: the source
+      id (size, modification time), the UUID of the TFile and the 
+      number of entries of the tree have to agree.
+    """
+    if feature_file_name is None:
+        feature_file_name = get_feature_file_name(file_name)
+    if not os.path.exists(file_name) or not os.path.exists(feature_file_name): 
+        return None
+    table = numpy.load(feature_file_name)
+    if ("source_id" not in table.files or "uuid" not in table.files or
+        not numpy.array_equal(table["source_id"], get_source_id(file_name))):
+        return None
+    features = dict((key, table[key]) for key in table.files 
+                    if key not in ("source_id", "uuid"))
+    open_file = ROOT.TFile(file_name)
+    uuid, num_entries = get_tree_id(open_file)
+    open_file.Close()
+    if str(table["uuid"]) != uuid or len(features["entry"]) != num_entries: 
+        return None
+    return features
+
+def load_event_features(file_name, feature_file_name=None):
+    """
+      Return the feature table of the energy_output_tree in
+      file_name.  It is read from feature_file_name if it was made
+      from the same version of file_name (see read_event_features),
+      otherwise it is computed and written again.
+    """
+    features = read_event_features(file_name, feature_file_name)
+    if features is None: 
+        features = write_event_features(file_name, feature_file_name)
+    return features
+
+def merge_event_features(tables):
+    """
+      Concatenate feature tables, e.g. of consecutive chunks of a
+      run, renumbering the entries.
+    """
+    merged = dict((key, numpy.concatenate([table[key] for table in tables]))
+                  for key in tables[0])
+    merged["entry"] = numpy.arange(len(merged["entry"]), dtype=numpy.uint32)
+    return merged
+
+class EventFeatures:
+    """
+      Collects the feature table while the energy_output_tree is
+      filled (see analyze_waveforms.analyze_events), instead of 
+      reading the tree back afterwards:
+
+        features = EventFeatures()
+        ...
+        features.add_event(channel_info, risetime_info, pulser_on)
+        ...
+        write_event_features(file_name, columns=features.get_table())
+    """
+    # The fields of the channels 0 and 1 used by get_event_features
+    channel_keys = ("channel_info.averagepeak", "channel_info.baseline",
+                    "channel_info.minimum", "risetime_info.maximum", 
+                    "risetime_info.minimum")
+    num_channels = 2
+
+    def __init__(self):
+        self.values = dict((key, []) for key in self.channel_keys)
+        self.pulser_on = []
+
+    def add_event(self, channel_info, risetime_info, pulser_on):
+        for key in self.channel_keys:
+            info_name, field = key.split(".")
+            info = risetime_info if info_name == "risetime_info" else channel_info
+            # Channels missing in the event are NaN, as in the columns
+            row = [numpy.nan]*self.num_channels
+            for chan in range(min(info.GetNumChannels(), self.num_channels)):
+                row[chan] = getattr(info.GetChannel(chan), field)
+            self.values[key].append(row)
+        self.pulser_on.append(pulser_on)
+
+    def get_table(self):
+        columns = dict((key, numpy.array(values, dtype=numpy.float64).reshape(
+                                           -1, self.num_channels))
+                       for key, values in self.values.items())
+        columns["pulser_on"] = numpy.array(self.pulser_on, dtype=numpy.uint32)
+        return get_event_features(columns)
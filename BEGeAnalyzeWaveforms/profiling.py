@@ -0,0 +1,165 @@
+"""
+  Optional timing instrumentation of the waveform analysis.  A
+  StageProfiler accumulates the wall and CPU time of each stage
+  between start(stage) and stop(stage), counts the events and
+  prints a progress line (events/s, RSS) every progress_interval
+  seconds, e.g.:
+
+    profiler = StageProfiler(num_events)
+    profiler.start("tree_read")
+    ...
+    profiler.stop("tree_read")
+    profiler.event_done()
+    profiler.write_summary("profile.json")
+
+  NullProfiler has the same interface and does nothing, it is
+  used when the instrumentation is off.
+"""
+import os
+import sys
+import time
+import json
+import resource
+
+def get_rss():
+    """
+      Current resident memory of this process in MB (the peak
+      resident memory where /proc is not available).
+    """
+    try:
+        statm = open("/proc/self/statm")
+        try: pages = int(statm.read().split()[1])
+        finally: statm.close()
+        return pages*os.sysconf("SC_PAGE_SIZE")/(1024.*1024.)
+    except (IOError, ValueError, OSError):
+        return get_peak_rss()
+
+def get_peak_rss():
+    """
+      Peak resident memory of this process in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+def get_cpu_time():
+    user, system = os.times()[:2]
+    return user + system
+
+class NullProfiler:
+    def start(self, stage): pass
+    def stop(self, stage): pass
+    def event_done(self, num_events=1): pass
+    def finish(self): pass
+
+class StageProfiler:
+    def __init__(self, total_events=None, progress_interval=10., output=sys.stdout):
+        self.total_events = total_events
+        self.progress_interval = progress_interval
+        self.output = output
+        self.stages = []
+        self.wall_time = {}
+        self.cpu_time = {}
+        self.calls = {}
+        self.started = {}
+        self.events = 0
+        self.start_wall = time.time()
+        self.start_cpu = get_cpu_time()
+        self.last_progress = self.start_wall
+        self.end_wall = None
+        self.end_cpu = None
+
+    def start(self, stage):
+        self.started[stage] = (time.time(), get_cpu_time())
+
+    def stop(self, stage):
+        wall, cpu = self.started.pop(stage)
+        if stage not in self.wall_time:
+            self.stages.append(stage)
+            self.wall_time[stage] = 0.
+            self.cpu_time[stage] = 0.
+            self.calls[stage] = 0
+        self.wall_time[stage] += time.time() - wall
+        self.cpu_time[stage] += get_cpu_time() - cpu
+        self.calls[stage] += 1
+
+    def event_done(self, num_events=1):
+        self.events += num_events
+        now = time.time()
+        if now - self.last_progress >= self.progress_interval:
+            self.last_progress = now
+            self.print_progress(now)
+
+    def print_progress(self, now):
+        events = "%i" % self.events
+        if self.total_events: events += "/%i" % self.total_events
+        elapsed = now - self.start_wall
+        print >> self.output, "Progress: %s events, %.1f events/s, %.1f s, RSS %.1f MB" % \
+          (events, self.events/max(elapsed, 1e-9), elapsed, get_rss())
+
+    def finish(self):
+        """
+          Stop the total timing, called at the end of the run
+        """
+        self.end_wall = time.time()
+        self.end_cpu = get_cpu_time()
+
+    def get_summary(self):
+        """
+          Dictionary of the totals and, in stages, the wall time,
+          cpu time, calls and fraction of the total wall time of
+          each stage.
+        """
+        if self.end_wall is None: self.finish()
+        wall = self.end_wall - self.start_wall
+        summary = { 'events' : self.events,
+                    'wall_time' : wall,
+                    'cpu_time' : self.end_cpu - self.start_cpu,
+                    'events_per_second' : self.events/max(wall, 1e-9),
+                    'peak_rss_mb' : get_peak_rss(),
+                    'stage_order' : self.stages,
+                    'stages' : {} }
+        for stage in self.stages:
+            summary['stages'][stage] = { 'wall_time' : self.wall_time[stage],
+                                         'cpu_time' : self.cpu_time[stage],
+                                         'calls' : self.calls[stage],
+                                         'fraction' : self.wall_time[stage]/max(wall, 1e-9) }
+        return summary
+
+    def write_summary(self, file_name):
+        write_summary(self.get_summary(), file_name)
+
+def write_summary(summary, file_name):
+    output = open(file_name, "w")
+    try:
+        json.dump(summary, output, indent=2, sort_keys=True)
+    finally:
+        output.close()
+
+def merge_summaries(summaries):
+    """
+      Combine the summaries of several processes (e.g. the chunks
+      of a parallel run): the times and events are summed, the wall
+      time is the longest of the summaries and the peak RSS is the
+      largest.
+    """
+    merged = { 'events' : 0, 'wall_time' : 0., 'cpu_time' : 0.,
+               'peak_rss_mb' : 0., 'stage_order' : [], 'stages' : {} }
+    stage_wall = 0.
+    for summary in summaries:
+        merged['events'] += summary['events']
+        merged['cpu_time'] += summary['cpu_time']
+        merged['wall_time'] = max(merged['wall_time'], summary['wall_time'])
+        merged['peak_rss_mb'] = max(merged['peak_rss_mb'], summary['peak_rss_mb'])
+        stage_wall += summary['wall_time']
+        for stage in summary['stage_order']:
+            values = summary['stages'][stage]
+            if stage not in merged['stages']:
+                merged['stage_order'].append(stage)
+                merged['stages'][stage] = { 'wall_time' : 0., 'cpu_time' : 0., 'calls' : 0 }
+            for key in ('wall_time', 'cpu_time', 'calls'):
+                merged['stages'][stage][key] += values[key]
+    merged['events_per_second'] = merged['events']/max(merged['wall_time'], 1e-9)
+    # fraction of the summed wall time of the processes
+    for stage in merged['stage_order']:
+        merged['stages'][stage]['fraction'] = \
+          merged['stages'][stage]['wall_time']/max(stage_wall, 1e-9)
+    return merged
@@ -0,0 +1,169 @@
+"""
+  Run configuration shared by parseBeGe (-c/--config) and the
+  analysis: the layout of the raw records and the time windows of
+  the analysis.  The file is plain text, one "key = value" per
+  line ('#' starts a comment), any key not given keeps its default:
+
+    waveform_length = 16000
+    rise_window_start_us = 695.2
+
+  The keys, with the defaults of the Soudan BeGe runs, are:
+
+    waveform_length             8000   samples per waveform
+    num_waveforms_per_trigger   6      (waveforms are stored in pairs)
+    sampling_frequency_MHz      20
+    extra_words                 4      32-bit words (datetime, pulser
+                                       chunks, at least 4) after the
+                                       first pair
+    baseline_time_us            280    baseline of the shaped channels
+    rise_window_start_us        295.2  risetime window of the preamp
+    rise_window_length_us       30       traces, from the trace start
+    swt_margin_before_us        100    included in the wavelet
+    swt_margin_after_us         30       denoising around the window
+    swt_level                   6      at most 6 (get_threshold_list)
+
+  The wavelet denoising uses the smallest dyadic (2^N) window that
+  holds the risetime window and its margins (4096 samples from sample
+  3904 for the defaults), so longer traces do not make the denoising
+  more expensive.
+"""
+
+# The wavelet denoising has thresholds for this many levels
+# (analyze_waveforms.get_threshold_list)
+max_swt_level = 6
+
+default_values = [('waveform_length', 8000),
+                  ('num_waveforms_per_trigger', 6),
+                  ('sampling_frequency_MHz', 20.),
+                  ('extra_words', 4),
+                  ('baseline_time_us', 280.),
+                  ('rise_window_start_us', 295.2),
+                  ('rise_window_length_us', 30.),
+                  ('swt_margin_before_us', 100.),
+                  ('swt_margin_after_us', 30.),
+                  ('swt_level', 6)]
+
+class RunConfiguration:
+    """
+      The values of the configuration are attributes (with the names
+      of the keys).  The derived values, in the units of MGDO (CLHEP,
+      ns) or in samples/words, are:
+
+        sampling_frequency, baseline_time, length_of_pulse
+
+        words_per_waveform_pair, words_per_trigger,
+        trigger_event_size_in_bytes
+        pair_word_offsets    first word of each waveform pair in a record
+        extra_word_offset    first of the extra words
+
+        swt_window_offset, swt_window_length
+                             the dyadic window of the wavelet denoising
+        pulse_start          start of the risetime window, from the
+                             start of the dyadic window (ns)
+        pulse_start_sample, pulse_samples
+                             the same in samples, and its length
+    """
+    def __init__(self, **values):
+        for key, value in default_values:
+            setattr(self, key, type(value)(values.pop(key, value)))
+        if values:
+            raise ValueError("Unknown run configuration keys: %s" %
+                             ", ".join(sorted(values)))
+        self.update()
+
+    def update(self):
+        """
+          Calculate the derived values, call after changing any of
+          the configuration values
+        """
+        if self.num_waveforms_per_trigger % 2 != 0:
+            raise ValueError("The waveforms are stored in pairs, "
+                             "num_waveforms_per_trigger must be even")
+        if self.extra_words < 4:
+            raise ValueError("The datetime and pulser chunks need extra_words >= 4")
+        if not 1 <= self.swt_level <= max_swt_level:
+            raise ValueError("swt_level must be between 1 and %i" % max_swt_level)
+        # MHz in CLHEP units (1/ns)
+        self.sampling_frequency = self.sampling_frequency_MHz*1e-3
+        self.baseline_time = self.baseline_time_us*1e3
+        self.length_of_pulse = self.rise_window_length_us*1e3
+
+        # Record layout
+        self.words_per_waveform_pair = 2*self.waveform_length
+        self.words_per_trigger = (self.num_waveforms_per_trigger*self.waveform_length +
+                                  self.extra_words)
+        self.trigger_event_size_in_bytes = 4*self.words_per_trigger
+        self.pair_word_offsets = []
+        offset = 0
+        for pair in range(self.num_waveforms_per_trigger//2):
+            self.pair_word_offsets.append(offset)
+            offset += self.words_per_waveform_pair
+            if pair == 0:
+                self.extra_word_offset = offset
+                offset += self.extra_words
+
+        # The dyadic window of the wavelet denoising
+        def to_samples(time_us):
+            return int(round(time_us*1e3*self.sampling_frequency))
+        rise_start = to_samples(self.rise_window_start_us)
+        self.pulse_samples = to_samples(self.rise_window_length_us)
+        if rise_start < 0 or rise_start + self.pulse_samples > self.waveform_length:
+            raise ValueError("The risetime window (samples %i to %i) is outside the "
+                             "waveforms (%i samples)" % (rise_start, 
+                             rise_start + self.pulse_samples, self.waveform_length))
+        first = max(rise_start - to_samples(self.swt_margin_before_us), 0)
+        last = rise_start + self.pulse_samples + to_samples(self.swt_margin_after_us)
+        self.swt_window_length = 2**self.swt_level
+        while self.swt_window_length < last - first: self.swt_window_length *= 2
+        if self.swt_window_length > self.waveform_length:
+            raise ValueError("The dyadic window (%i samples) is longer than the "
+                             "waveforms (%i samples)" %
+                             (self.swt_window_length, self.waveform_length))
+        # Keep the window inside the waveform
+        self.swt_window_offset = min(first, self.waveform_length - self.swt_window_length)
+        self.pulse_start_sample = rise_start - self.swt_window_offset
+        if self.pulse_start_sample + self.pulse_samples > self.swt_window_length:
+            raise ValueError("The risetime window is outside the dyadic window")
+        self.pulse_start = self.pulse_start_sample/self.sampling_frequency
+
+    def get_values(self):
+        return [(key, getattr(self, key)) for key, value in default_values]
+
+    def save(self, file_name):
+        output = open(file_name, "w")
+        try:
+            for key, value in self.get_values():
+                output.write("%s = %s\n" % (key, value))
+        finally:
+            output.close()
+
+def read_run_configuration(file_name):
+    """
+      Read a RunConfiguration from file_name, as written by
+      RunConfiguration.save (or by hand).
+    """
+    values = {}
+    input = open(file_name)
+    try:
+        for line in input:
+            line = line.split("#")[0].strip()
+            if not line: continue
+            key, value = [part.strip() for part in line.split("=", 1)]
+            values[key] = value
+    finally:
+        input.close()
+    defaults = dict(default_values)
+    for key in values:
+        if key in defaults: values[key] = type(defaults[key])(float(values[key]))
+    return RunConfiguration(**values)
+
+default_configuration = RunConfiguration()
+
+def get_run_configuration(config=None):
+    """
+      config may be a RunConfiguration, the name of a file
+      to read it from, or None for the default configuration
+    """
+    if config is None: return default_configuration
+    if isinstance(config, RunConfiguration): return config
+    return read_run_configuration(config)
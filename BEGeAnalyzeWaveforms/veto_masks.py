@@ -0,0 +1,42 @@
+"""
+  Batch muon-veto queries returning numpy boolean masks, using
+  the array versions of the MGMMuonVeto queries.  E.g. to check
+  the detector pulse window of every event in a block of the
+  energy_output_tree:
+
+    mask = get_event_veto_mask(tree, beginnings, ends, first_entry=0)
+"""
+import numpy
+
+def get_veto_mask(muon_veto, positions):
+    """
+      mask[i] = muon_veto.IsInVetoRegion(positions[i])
+    """
+    positions = numpy.ascontiguousarray(positions, dtype=numpy.uint64)
+    mask = numpy.zeros(len(positions), dtype=bool)
+    if len(positions): muon_veto.AreInVetoRegion(len(positions), positions, mask)
+    return mask
+
+def get_range_veto_mask(muon_veto, beginnings, ends):
+    """
+      mask[i] = muon_veto.RangeIsInVetoRegion(beginnings[i], ends[i])
+    """
+    beginnings = numpy.ascontiguousarray(beginnings, dtype=numpy.uint64)
+    ends = numpy.ascontiguousarray(ends, dtype=numpy.uint64)
+    mask = numpy.zeros(len(beginnings), dtype=bool)
+    if len(beginnings):
+        muon_veto.RangesAreInVetoRegion(len(beginnings), beginnings, ends, mask)
+    return mask
+
+def get_event_veto_mask(tree, beginnings, ends, first_entry=0):
+    """
+      For the block of entries of tree (energy_output_tree) starting
+      at first_entry, one range [beginnings[i], ends[i]] per entry,
+      mask[i] is True if the range overlaps the muon veto of entry 
+      first_entry + i. 
+    """
+    mask = numpy.zeros(len(beginnings), dtype=bool)
+    for i in range(len(beginnings)):
+        tree.GetEntry(first_entry + i)
+        mask[i] = tree.muon_veto.RangeIsInVetoRegion(int(beginnings[i]), int(ends[i]))
+    return mask
@@ -1,14 +1,63 @@
 #include "MGMMuonVeto.hh"
+#include <algorithm>
 
 ClassImp(MGMMuonVeto)
 
+static bool BeginsBefore(const MGWaveformRegion& a, const MGWaveformRegion& b)
+{
+  return a.beginning < b.beginning;
+}
+
+static bool EndsBefore(const MGWaveformRegion& region, size_t position)
+{
+  return region.end < position;
+}
+
+void MGMMuonVeto::AddRegion(size_t beginning, size_t end)
+{
+  /* Regions come (e.g. from the pulse finder) in order, in which
+     case this only appends. */
+  if (beginning > end) return;
+  if (regions.empty() || 
+      (regions.back().end < beginning && beginning - regions.back().end > 1)) {
+    regions.push_back(MGWaveformRegion(beginning, end));
+    return;
+  }
+  regions.push_back(MGWaveformRegion(beginning, end));
+  SortAndMerge();
+}
+
+void MGMMuonVeto::SortAndMerge()
+{
+  /* Drop empty regions (they contain no points), sort and merge
+     overlapping or adjacent regions.  Since the end points are 
+     inclusive, this doesn't change the result of any query. */
+  std::vector<MGWaveformRegion> merged;
+  merged.reserve(regions.size());
+  std::vector<MGWaveformRegion> sorted;
+  sorted.reserve(regions.size());
+  for (size_t i=0;i<regions.size();i++) {
+    if (regions[i].beginning <= regions[i].end) sorted.push_back(regions[i]);
+  }
+  std::sort(sorted.begin(), sorted.end(), BeginsBefore);
+  for (size_t i=0;i<sorted.size();i++) {
+    if (!merged.empty() && 
+        (sorted[i].beginning <= merged.back().end || 
+         sorted[i].beginning - merged.back().end == 1)) {
+      if (sorted[i].end > merged.back().end) merged.back().end = sorted[i].end;
+    } else {
+      merged.push_back(sorted[i]);
+    }
+  }
+  regions.swap(merged);
+}
+
 bool MGMMuonVeto::IsInVetoRegion(size_t test_position) 
 {
-  for( size_t i=0;i<regions.size();i++) {
-    if (test_position >= regions[i].beginning &&
-        test_position <= regions[i].end) return true;
-  } 
-  return false;
+  /* First region that ends at or after the test position */
+  std::vector<MGWaveformRegion>::const_iterator region = 
+    std::lower_bound(regions.begin(), regions.end(), test_position, EndsBefore);
+  return (region != regions.end() && region->beginning <= test_position);
 }
     
 bool MGMMuonVeto::RangeIsInVetoRegion(size_t beginning, size_t end)
@@ -17,16 +66,26 @@ bool MGMMuonVeto::RangeIsInVetoRegion(size_t beginning, size_t end)
  *   1. test_region is completely inside a veto region. 
  *   2. test_region beginning is inside a veto region, end outside. 
  *   3. test_region end is inside a veto region, beginning outside.
- *   4. test_region beginning is before a veto region, end is after. */
-
-  /* This takes care of the first 3 cases. */
-  if (IsInVetoRegion(beginning)) return true;
-  else if (IsInVetoRegion(end)) return true;
-
-  /* This takes care of the last case. */
-  for( size_t i=0;i<regions.size();i++) {
-    if (beginning <= regions[i].beginning &&
-        end >= regions[i].end) return true;
-  } 
-  return false;
+ *   4. test_region beginning is before a veto region, end is after. 
+ * For beginning <= end, these are all covered by the first region 
+ * ending at or after beginning starting at or before end.  Otherwise,
+ * only the first 2 cases can happen. */
+
+  if (beginning > end) {
+    return (IsInVetoRegion(beginning) || IsInVetoRegion(end));
+  }
+  std::vector<MGWaveformRegion>::const_iterator region = 
+    std::lower_bound(regions.begin(), regions.end(), beginning, EndsBefore);
+  return (region != regions.end() && region->beginning <= end);
+}
+
+void MGMMuonVeto::AreInVetoRegion(size_t n, const size_t* positions, Bool_t* mask)
+{
+  for (size_t i=0;i<n;i++) mask[i] = IsInVetoRegion(positions[i]);
+}
+
+void MGMMuonVeto::RangesAreInVetoRegion(size_t n, const size_t* beginnings, 
+                                        const size_t* ends, Bool_t* mask)
+{
+  for (size_t i=0;i<n;i++) mask[i] = RangeIsInVetoRegion(beginnings[i], ends[i]);
 }
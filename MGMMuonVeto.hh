@@ -1,4 +1,3 @@
-
 #ifndef _MGMMuonVeto_hh_
 #define _MGMMuonVeto_hh_ 1
 #include "TObject.h"
@@ -18,9 +17,23 @@ class MGMMuonVeto: public TObject
 {
 
   public:
+    /* The regions are kept sorted and merged (non-overlapping, 
+       non-adjacent) so that the queries can use a binary search.
+       Use AddRegion to fill them, or call SortAndMerge after 
+       modifying regions directly. */
     std::vector<MGWaveformRegion> regions;
+    void AddRegion(size_t beginning, size_t end);
+    void SortAndMerge();
+
     bool IsInVetoRegion(size_t);
     bool RangeIsInVetoRegion(size_t beginning, size_t end);
+
+    /* Batch versions of the queries, filling mask[i] for each of
+       the n positions (ranges).  From python, numpy arrays can 
+       be passed (uint64 for size_t, bool for mask). */
+    void AreInVetoRegion(size_t n, const size_t* positions, Bool_t* mask);
+    void RangesAreInVetoRegion(size_t n, const size_t* beginnings, 
+                               const size_t* ends, Bool_t* mask);
   public:
     size_t GetNumberOfRegions() { return regions.size(); }
     
@@ -9,39 +9,66 @@
 #include "TFile.h"
 #include "TTree.h"
 #include <getopt.h>
+#include <cstdlib>
+#include <cstdio>
 #include <arpa/inet.h>
 using namespace std;
 
 static const char Usage[] =
 "\n"
-"Usage: [program] [binary_input_file] [output_root_file]\n"
+"Usage: [program] [options] [binary_input_file] [output_root_file]\n"
+"\n"
+"  -n, --triggers-per-read N : number of triggers read from the file\n"
+"                              in one block (default 64)\n"
+"  -c, --config FILE         : run configuration file, giving the record\n"
+"                              layout (waveform_length,\n"
+"                              num_waveforms_per_trigger,\n"
+"                              sampling_frequency_MHz, extra_words), the\n"
+"                              same file as for the analysis, see\n"
+"                              BEGeAnalyzeWaveforms/run_config.py\n"
+"  -i, --incremental         : append only the triggers not yet in the\n"
+"                              output file, recording the progress in\n"
+"                              [output_root_file].checkpoint.  An\n"
+"                              incomplete trigger at the end of the\n"
+"                              input (a file still being written) is\n"
+"                              left for the next pass.\n"
 "\n";
 
 /* Swap buffer swaps along 32-bit boundaries. Uses
-   ntohl for portability. */
+   ntohl for portability. This is called on whole blocks
+   of triggers, the simple loop allows the compiler
+   to vectorize it. */
 void swap_buffer(char* buffer, size_t length)
 {
-    uint32_t* data_buffer = (uint32_t*) buffer;
+    uint32_t* __restrict__ data_buffer = (uint32_t*) buffer;
     length /= sizeof(data_buffer[0]);
     for (size_t i=0;i<length;i++) {
         data_buffer[i] = ntohl(data_buffer[i]); 
     }
 }
 
-/* Reading the waveforms, 2 waveforms interlaced in a "column" format. */
+/* Reading the waveforms, 2 waveforms interlaced in a "column" format. 
+   The data are de-interleaved into the scratch arrays and then
+   set in the waveforms in one call. */
 char* read_waveforms(MGTWaveform& waveform_one, MGTWaveform& waveform_two, 
                     char* buffer, size_t length_of_waveforms)
 {
-  waveform_one.SetLength(length_of_waveforms);
-  waveform_two.SetLength(length_of_waveforms);
-  uint32_t* data_buffer = (uint32_t*) buffer;
-  for (size_t i=0;i<waveform_one.GetLength();i++){
+  static vector<double> scratch_one;
+  static vector<double> scratch_two;
+  scratch_one.resize(length_of_waveforms);
+  scratch_two.resize(length_of_waveforms);
+  const float* __restrict__ data_buffer = (const float*) buffer;
+  double* __restrict__ one = &scratch_one[0];
+  double* __restrict__ two = &scratch_two[0];
+  for (size_t i=0;i<length_of_waveforms;i++){
     // Data in the binary are raw IEEE float values.  
     // This casting allows them to be set in the native
     // MGTWaveform format (double)
-    waveform_one[i] = *((float*) (data_buffer+2*i));  
-    waveform_two[i] = *((float*) (data_buffer+2*i + 1));  
+    one[i] = data_buffer[2*i];  
+    two[i] = data_buffer[2*i + 1];  
   }
+  waveform_one.SetData(one, length_of_waveforms);
+  waveform_two.SetData(two, length_of_waveforms);
   return buffer + 2*length_of_waveforms*sizeof(data_buffer[0]);
 }
 
@@ -74,34 +101,154 @@ void prepare_for_next_trigger(MGTEvent& event,
   }
 }
 
+/* Reading the run configuration, lines of "key = value" ('#' starts
+   a comment).  Only the keys of the record layout are used here, 
+   the others are for the analysis. */
+string trim(const string& text)
+{
+  size_t first = text.find_first_not_of(" \t\r");
+  if (first == string::npos) return "";
+  size_t last = text.find_last_not_of(" \t\r");
+  return text.substr(first, last - first + 1);
+}
+
+bool read_run_configuration(const string& config_file_name, 
+                            size_t& waveform_length, 
+                            size_t& num_waveforms_per_trigger,
+                            double& sampling_frequency_MHz,
+                            size_t& extra_words)
+{
+  ifstream config(config_file_name.c_str());
+  if (!config.is_open()) return false;
+  string line;
+  while (getline(config, line)) {
+    line = line.substr(0, line.find('#'));
+    size_t equals = line.find('=');
+    if (equals == string::npos) continue;
+    string key = trim(line.substr(0, equals));
+    double value = atof(trim(line.substr(equals + 1)).c_str());
+    if (key == "waveform_length") waveform_length = (size_t)value;
+    else if (key == "num_waveforms_per_trigger") num_waveforms_per_trigger = (size_t)value;
+    else if (key == "sampling_frequency_MHz") sampling_frequency_MHz = value;
+    else if (key == "extra_words") extra_words = (size_t)value;
+  }
+  return true;
+}
+
+/* The checkpoint of the incremental mode holds the number of
+   triggers processed and the name of the input file (its absolute
+   path, so that a pass may be resumed from any directory).  It is 
+   written to a temporary file and renamed so that it is never
+   left half written. */
+string get_absolute_path(const string& file_name)
+{
+  char* path = realpath(file_name.c_str(), NULL);
+  if (!path) return file_name;
+  string absolute_path(path);
+  free(path);
+  return absolute_path;
+}
+
+bool read_checkpoint(const string& checkpoint_file_name, size_t& number_processed,
+                     string& input_file_name)
+{
+  ifstream checkpoint(checkpoint_file_name.c_str());
+  if (!checkpoint.is_open()) return false;
+  checkpoint >> number_processed;
+  checkpoint.ignore(); 
+  getline(checkpoint, input_file_name);
+  return !checkpoint.fail();
+}
+
+bool write_checkpoint(const string& checkpoint_file_name, size_t number_processed,
+                      const string& input_file_name)
+{
+  string temp_file_name = checkpoint_file_name + ".tmp";
+  ofstream checkpoint(temp_file_name.c_str());
+  checkpoint << number_processed << endl << input_file_name << endl;
+  checkpoint.close();
+  if (checkpoint.fail()) return false;
+  return rename(temp_file_name.c_str(), checkpoint_file_name.c_str()) == 0;
+}
+
 int main(int argc, char** argv)
 {
-  /* Define constants of the data record here. */
-  // These should in principle be defined at runtime.
-  const Double_t sampling_frequency = 20*CLHEP::MHz;
-  const size_t waveform_length = 8000; 
-  const size_t extra_bytes = 16;
+  /* Defaults of the data record, these may be changed
+     with a run configuration file (-c). */
+  double sampling_frequency_MHz = 20;
+  size_t waveform_length = 8000; 
+  size_t extra_words = 4;
   const size_t waveform_word_length = 4;
-  const size_t num_waveforms_per_trigger = 6;
-  const size_t trigger_event_size_in_bytes = waveform_word_length*num_waveforms_per_trigger*
-                                             waveform_length + extra_bytes;
+  size_t num_waveforms_per_trigger = 6;
+  string config_file_name;
 
-  char* data_buffer = new char[trigger_event_size_in_bytes];
+  // Number of triggers read in one block from the file
+  size_t triggers_per_read = 64;
+  // Append to the output instead of recreating it
+  bool incremental = false;
   
   static struct option longOptions[] = {
+    {"triggers-per-read", required_argument, 0, 'n'},
+    {"incremental", no_argument, 0, 'i'},
+    {"config", required_argument, 0, 'c'},
+    {0, 0, 0, 0}
   };
 
-  // Following is for eventual extension to allowing command line options
   while(1) {
-    char optId = getopt_long(argc, argv, "", longOptions, NULL);
+    char optId = getopt_long(argc, argv, "n:ic:", longOptions, NULL);
     if(optId == -1) break;
     switch(optId) {
+      case 'n':
+        triggers_per_read = strtoul(optarg, NULL, 10);
+        if (triggers_per_read == 0) {
+          cout << Usage;
+          return 1;
+        }
+        break;
+      case 'i':
+        incremental = true;
+        break;
+      case 'c':
+        config_file_name = optarg;
+        break;
       default: // unrecognized option
         cout << Usage;
         return 1;
     }
   }
 
+  if (config_file_name != "" && 
+      !read_run_configuration(config_file_name, waveform_length, num_waveforms_per_trigger,
+                              sampling_frequency_MHz, extra_words)) {
+    cout << "Unable to read the run configuration " << config_file_name << endl;
+    return 1;
+  }
+  // The datetime and the pulser chunks are in the extra words
+  if (num_waveforms_per_trigger % 2 != 0 || num_waveforms_per_trigger == 0 || 
+      extra_words < 4 || waveform_length == 0) {
+    cout << "Invalid record layout in the run configuration." << endl;
+    return 1;
+  }
+  const Double_t sampling_frequency = sampling_frequency_MHz*CLHEP::MHz;
+  const size_t trigger_event_size_in_bytes = waveform_word_length*
+    (num_waveforms_per_trigger*waveform_length + extra_words);
+
+  // Position (in bytes) of each waveform pair and of the extra 
+  // words in a record, the extra words follow the first pair 
+  vector<size_t> pair_offsets;
+  size_t extra_offset = 0;
+  size_t offset = 0;
+  for (size_t pair=0;pair<num_waveforms_per_trigger/2;pair++) {
+    pair_offsets.push_back(offset);
+    offset += 2*waveform_length*waveform_word_length;
+    if (pair == 0) {
+      extra_offset = offset;
+      offset += extra_words*waveform_word_length;
+    }
+  }
+
+  char* data_buffer = new char[triggers_per_read*trigger_event_size_in_bytes];
+
   // Output usage
   if (argc < optind + 2) {
     cout << Usage;
@@ -125,8 +272,14 @@ int main(int argc, char** argv)
 
   size_t size_of_file = end - begin;
   if (size_of_file % trigger_event_size_in_bytes != 0) {
-    cout << "File corrupted." << endl;
-    return 1;
+    // In the incremental mode the file may still be written, 
+    // only the complete triggers are read
+    if (!incremental) {
+      cout << "File corrupted." << endl;
+      return 1;
+    }
+    cout << "Incomplete trigger at the end of the file, "
+         << "it is left for the next pass." << endl;
   }
   // End sanity check
 
@@ -139,55 +292,117 @@ int main(int argc, char** argv)
   UInt_t pulser_chunk_two;
   ULong64_t datetime;
 
-  TFile open_file(root_output_file_name.c_str(), "recreate");
-  TTree tree("soudan_wf_analysis", "Soudan WF Tree");
-  tree.Branch("EventBranch", "MGTEvent", &event); 
-  tree.Branch("timestamp", &datetime, "timestamp/l");
-  tree.Branch("pulser_chunk_one", &pulser_chunk_one, "pulser_chunk_one/i");
-  tree.Branch("pulser_chunk_two", &pulser_chunk_two, "pulser_chunk_two/i");
-  
+  TFile open_file(root_output_file_name.c_str(), incremental ? "update" : "recreate");
+  TTree* tree = NULL;
+  if (incremental) tree = (TTree*) open_file.Get("soudan_wf_analysis");
+  if (tree) {
+    tree->SetBranchAddress("EventBranch", &event); 
+    tree->SetBranchAddress("timestamp", &datetime);
+    tree->SetBranchAddress("pulser_chunk_one", &pulser_chunk_one);
+    tree->SetBranchAddress("pulser_chunk_two", &pulser_chunk_two);
+  } else {
+    tree = new TTree("soudan_wf_analysis", "Soudan WF Tree");
+    tree->Branch("EventBranch", "MGTEvent", &event); 
+    tree->Branch("timestamp", &datetime, "timestamp/l");
+    tree->Branch("pulser_chunk_one", &pulser_chunk_one, "pulser_chunk_one/i");
+    tree->Branch("pulser_chunk_two", &pulser_chunk_two, "pulser_chunk_two/i");
+  }
 
   // Total number of events in the file
   size_t number_of_events = size_of_file/trigger_event_size_in_bytes;
   size_t number_read_out = 0;
-  do {
-    // Initialization
-    prepare_for_next_trigger(*event, 
-                             vector_of_waveforms, 
-                             num_waveforms_per_trigger,
-                             sampling_frequency);
-
-    // Read in the next event
-    binary_input_file.read(data_buffer, trigger_event_size_in_bytes);
-    if (binary_input_file.eof()) {
+
+  // Resume after the triggers already in the output.  The tree
+  // is saved before the checkpoint is written, so the tree may 
+  // be ahead of the checkpoint (after a crash) but never behind.
+  string checkpoint_file_name = root_output_file_name + ".checkpoint";
+  string checkpoint_input_name = get_absolute_path(binary_input_file_name);
+  if (incremental) {
+    number_read_out = tree->GetEntries();
+    size_t number_processed;
+    string checkpoint_input_file_name;
+    if (read_checkpoint(checkpoint_file_name, number_processed, checkpoint_input_file_name)) {
+      if (get_absolute_path(checkpoint_input_file_name) != checkpoint_input_name) {
+        cout << "Checkpoint is for a different input file: " 
+             << checkpoint_input_file_name << endl;
+        return 1;
+      }
+      if (number_processed > number_read_out) {
+        cout << "Output file has fewer triggers (" << number_read_out 
+             << ") than the checkpoint (" << number_processed << ")." << endl;
+        return 1;
+      }
+    }
+    if (number_read_out > number_of_events) {
+      cout << "Output file has more triggers (" << number_read_out 
+           << ") than the input file (" << number_of_events << ")." << endl;
+      return 1;
+    }
+    binary_input_file.seekg((streamoff)(number_read_out*trigger_event_size_in_bytes), 
+                            ios::beg);
+    cout << "Resuming after trigger " << number_read_out << ", " 
+         << number_of_events - number_read_out << " new triggers." << endl;
+  }
+  size_t number_to_read_out = number_of_events - number_read_out;
+  size_t number_read_in_pass = 0;
+
+  while (number_read_out < number_of_events) {
+    // Read in the next block of triggers 
+    size_t triggers_in_block = number_of_events - number_read_out;
+    if (triggers_in_block > triggers_per_read) triggers_in_block = triggers_per_read;
+    size_t block_size_in_bytes = triggers_in_block*trigger_event_size_in_bytes;
+    binary_input_file.read(data_buffer, block_size_in_bytes);
+    if ((size_t)binary_input_file.gcount() != block_size_in_bytes) {
         cout << "End of file reached prematurely?" << endl;
+        break;
     }
 
     // Swap buffer to host machines endianness
-    swap_buffer(data_buffer, trigger_event_size_in_bytes); 
-
-    // Read the first two waveforms (chan 0, chan 1)
-    char* next_read = read_waveforms(*vector_of_waveforms[0], *vector_of_waveforms[1], data_buffer, waveform_length);
-    // Read the time and  
-    next_read = read_pulser_chunk_plus_datetime(pulser_chunk_one, pulser_chunk_two, datetime, next_read); 
-    // Read the next two waveforms, chan 2, muon veto
-    next_read = read_waveforms(*vector_of_waveforms[2], *vector_of_waveforms[3], next_read, waveform_length);
-    // Read the final two waveforms, raw preamp trace 1 and 2
-    next_read = read_waveforms(*vector_of_waveforms[4], *vector_of_waveforms[5], next_read, waveform_length);
-
-    // Fill the tree with this event.
-    tree.Fill();
-
-    // Peek forces the eof flag to be set if it encounters the end 
-    // of the file,  The ensures a correct exit from this loop.
-    binary_input_file.peek();
-    number_read_out++;
-  } while (!binary_input_file.eof());
+    swap_buffer(data_buffer, block_size_in_bytes); 
+
+    for (size_t trigger=0;trigger<triggers_in_block;trigger++) {
+      // Initialization
+      prepare_for_next_trigger(*event, 
+                               vector_of_waveforms, 
+                               num_waveforms_per_trigger,
+                               sampling_frequency);
+      char* trigger_buffer = data_buffer + trigger*trigger_event_size_in_bytes;
+
+      // Read the waveform pairs, for the default layout: 
+      // (chan 0, chan 1), (chan 2, muon veto), (raw preamp trace 1, 2)
+      for (size_t pair=0;pair<pair_offsets.size();pair++) {
+        read_waveforms(*vector_of_waveforms[2*pair], *vector_of_waveforms[2*pair+1], 
+                       trigger_buffer + pair_offsets[pair], waveform_length);
+      }
+      // Read the time and the pulser chunks 
+      read_pulser_chunk_plus_datetime(pulser_chunk_one, pulser_chunk_two, datetime, 
+                                      trigger_buffer + extra_offset); 
+
+      // Fill the tree with this event.
+      tree->Fill();
+      number_read_out++;
+      number_read_in_pass++;
+    }
+
+    // Save the tree and record the progress, so an interrupted
+    // pass is resumed after the last complete block
+    if (incremental) {
+      tree->AutoSave("SaveSelf");
+      if (!write_checkpoint(checkpoint_file_name, number_read_out, checkpoint_input_name)) {
+        cout << "Error writing checkpoint " << checkpoint_file_name << endl;
+        return 1;
+      }
+    }
+  }
   
-  if (number_read_out != number_of_events) {
+  if (number_read_in_pass != number_to_read_out) {
     cout << "Error reading file" << endl;
   } 
-  tree.Write("", TObject::kOverwrite);
+  open_file.cd();
+  tree->Write("", TObject::kOverwrite);
+  if (incremental) {
+    write_checkpoint(checkpoint_file_name, number_read_out, checkpoint_input_name);
+  }
 
   return 0;
 }